@@ -0,0 +1,143 @@
+"""Checks that the hot queries of the user DB are answered from indexes.
+
+Runs each query below through UserDbConn, records the statements it executes and prints their
+EXPLAIN QUERY PLAN. Exits with status 1 if any of them scans a whole table, as the time of such a
+query grows with the history kept in the table.
+
+SQLite picks indexes from the statistics gathered by ANALYZE. A new database is given the
+statistics of one with a long history, so the plans are the ones the bot would get in the long
+run. To check against real statistics, pass a copy of the bot's database.
+
+Run from the repository root
+    python extra/check_query_plans.py [db]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tle.util.db.user_db_conn import UserDbConn
+
+# (method, args) of the UserDbConn methods to check.
+HOT_METHODS = [
+    ('check_duel_challenge', (1,)),
+    ('check_duel_accept', (1,)),
+    ('check_duel_decline', (1,)),
+    ('check_duel_withdraw', (1,)),
+    ('check_duel_draw', (1,)),
+    ('check_duel_complete', (1,)),
+    ('get_duel_wins', (1,)),
+    ('get_duels', (1,)),
+    ('get_duel_problem_names', (1,)),
+    ('get_pair_duels', (1, 2)),
+    ('get_recent_duels', ()),
+    ('get_ongoing_duels', ()),
+    ('get_num_duel_completed', (1,)),
+    ('get_num_duel_draws', (1,)),
+    ('get_num_duel_losses', (1,)),
+    ('get_num_duel_declined', (1,)),
+    ('get_num_duel_rdeclined', (1,)),
+    ('get_complete_official_duels', ()),
+    ('check_challenge', (1,)),
+    ('get_gudgitters_last', (0,)),
+    ('get_gudgitters_timerange', (0, 1)),
+    ('howgud', (1,)),
+    ('get_noguds', (1,)),
+    ('gitlog', (1,)),
+    ('get_user_points', (1,)),
+    ('get_ongoing_rated_vc_ids', ()),
+]
+
+# Queries the cogs run directly on the connection.
+HOT_QUERIES = [
+    ('SELECT last_submission_id, current_month_points FROM gamification_points '
+     'WHERE user_id = ? AND guild_id = ?', ('1', '1')),
+    ('UPDATE gamification_points SET current_month_points = current_month_points + ? '
+     'WHERE (user_id = ? OR user_id = ?) AND guild_id = ?', (1, '1', '2', '1')),
+    ('SELECT problem_names, challenger_completed, challengee_completed FROM advanced_duel_data '
+     'WHERE duel_id = ?', (1,)),
+]
+
+# sqlite_stat1 rows of a database with a long history: the number of rows of the index, then the
+# average number of rows with the same value of its first column, first two columns and so on.
+LONG_HISTORY_STATS = [
+    ('duel', 'ix_duel_challenger_status', '100000 100 25'),
+    ('duel', 'ix_duel_challengee_status', '100000 100 25'),
+    ('duel', 'ix_duel_status_start_time', '100000 15000 1'),
+    ('challenge', 'ix_challenge_finish_time', '200000 2 1 1'),
+    ('challenge', 'ix_challenge_user_id_status', '200000 200 50'),
+    ('rated_vcs', 'ix_rated_vcs_status', '1000 300'),
+]
+
+
+def add_long_history_stats(conn):
+    conn.conn.execute('ANALYZE')
+    with conn.conn:
+        conn.conn.executemany('DELETE FROM sqlite_stat1 WHERE tbl = ? AND idx = ?',
+                              [(tbl, idx) for tbl, idx, _ in LONG_HISTORY_STATS])
+        conn.conn.executemany('INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (?, ?, ?)',
+                              LONG_HISTORY_STATS)
+    # Makes SQLite load the statistics again.
+    conn.conn.execute('ANALYZE sqlite_master')
+
+
+def record_statements(conn, func):
+    statements = []
+    conn.conn.set_trace_callback(statements.append)
+    try:
+        func()
+    finally:
+        conn.conn.set_trace_callback(None)
+    statements = [statement.strip() for statement in statements]
+    # Leave out the transaction control added by the sqlite3 module.
+    return [statement for statement in statements
+            if not statement.upper().startswith(('BEGIN', 'COMMIT', 'ROLLBACK'))]
+
+
+def query_plan(conn, statement):
+    rows = conn._fetch_tuples('EXPLAIN QUERY PLAN ' + statement)
+    return [detail for _, _, _, detail in rows]
+
+
+def check(conn, name, statements):
+    ok = True
+    for statement in statements:
+        plan = query_plan(conn, statement)
+        scans = [detail for detail in plan if detail.startswith('SCAN ')]
+        ok = ok and not scans
+        print(f'{"SCAN" if scans else "ok":>4}  {name}')
+        for detail in plan:
+            print(f'        {detail}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('db', nargs='?', help='user DB to check, a new one if not given')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        conn = UserDbConn(args.db or os.path.join(tmp_dir, 'user.db'))
+        if args.db is None:
+            add_long_history_stats(conn)
+        ok = True
+        for method, method_args in HOT_METHODS:
+            func = getattr(conn, method)
+            statements = record_statements(conn, lambda: func(*method_args))
+            ok = check(conn, method, statements) and ok
+        for query, params in HOT_QUERIES:
+            statements = record_statements(conn, lambda: conn.conn.execute(query, params))
+            conn.conn.rollback()
+            ok = check(conn, query.split(' WHERE')[0], statements) and ok
+        conn.close()
+
+    if not ok:
+        sys.exit('Some queries scan a whole table')
+
+
+if __name__ == '__main__':
+    main()
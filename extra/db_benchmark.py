@@ -0,0 +1,534 @@
+"""Generates large synthetic databases and times the database methods on them.
+
+    generate    Creates a user.db and a cache.db shaped like those of a bot on many big
+                guilds: members spread unevenly over the guilds, years of contests with their
+                rating changes, and long duel and gitgud histories. The scale is configurable,
+                the defaults are 100k memberships over 500 guilds and 5M rating changes.
+    run         Times the startup loads of the caches and every public method of UserDbConn
+                and CacheDbConn on copies of the generated databases. Results can be saved and
+                compared against a saved baseline, in which case slower methods are reported
+                and the exit status is 1.
+
+Run from the repository root, for example
+    python extra/db_benchmark.py generate data/bench
+    python extra/db_benchmark.py run data/bench --save baseline.json
+    python extra/db_benchmark.py run data/bench --baseline baseline.json
+"""
+
+import argparse
+import inspect
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tle.util import codeforces_api as cf
+from tle.util.db.cache_db_conn import CacheDbConn
+from tle.util.db.user_db_conn import UserDbConn, Duel, DuelType, Gitgud, Winner, RatedVC
+
+TAGS = ['implementation', 'math', 'greedy', 'dp', 'data structures', 'brute force',
+        'constructive algorithms', 'graphs', 'sortings', 'binary search', 'dfs and similar',
+        'trees', 'strings', 'number theory', 'combinatorics', 'two pointers', 'bitmasks',
+        'geometry', 'dsu', 'shortest paths', 'probabilities', 'divide and conquer', 'hashing',
+        'games', 'interactive', 'flows', 'matrices', 'fft', 'graph matchings',
+        'string suffix structures', 'ternary search', 'expression parsing', '2-sat',
+        'meet-in-the-middle', 'chinese remainder theorem', 'schedules', '*special']
+FIRST_CONTEST_TIME = 1262304000  # 2010-01-01
+LAST_CONTEST_TIME = 1735689600  # 2025-01-01
+FIRST_ID = 10**17
+
+
+# Generation.
+
+def guild_sizes(num_guilds, num_members, rng):
+    # A few big guilds and a long tail of small ones.
+    weights = [1 / (rank + 1) for rank in range(num_guilds)]
+    total = sum(weights)
+    sizes = [max(1, int(num_members * weight / total)) for weight in weights]
+    rng.shuffle(sizes)
+    return sizes
+
+
+def generate_cache_db(path, handles, rng, args):
+    conn = CacheDbConn(path)
+    num_contests = max(1, args.rating_changes // args.contest_size)
+    step = (LAST_CONTEST_TIME - FIRST_CONTEST_TIME) // num_contests
+    contests = [(1 + i, f'Codeforces Round {1 + i}', FIRST_CONTEST_TIME + i * step, 7200, 'CF',
+                 'FINISHED', None)
+                for i in range(num_contests)]
+    conn.cache_contests(contests)
+
+    rating = {}
+    changes, fetched = [], []
+    remaining = args.rating_changes
+    for i, (contest_id, name, start_time, duration, *_) in enumerate(contests):
+        size = remaining // (num_contests - i)
+        remaining -= size
+        # Newer contests draw from a bigger part of the handles, like the growing community.
+        pool = max(size, len(handles) * (i + 1) // num_contests)
+        participants = rng.sample(range(pool), size)
+        update_time = start_time + duration + 3600
+        for rank, index in enumerate(participants, start=1):
+            handle = handles[index]
+            old_rating = rating.get(handle, 1500)
+            delta = int(150 * (size / 2 - rank) / size + rng.gauss(0, 20))
+            rating[handle] = old_rating + delta
+            changes.append(cf.RatingChange(contest_id, name, handle, rank, update_time,
+                                           old_rating, old_rating + delta))
+        fetched.append((contest_id, size))
+        if len(changes) >= 200000 or i == num_contests - 1:
+            conn.save_rating_changes_batch(changes, fetched, LAST_CONTEST_TIME)
+            changes, fetched = [], []
+            print(f'\r{i + 1}/{num_contests} contests', end='', flush=True)
+    print()
+
+    problems = []
+    for i in range(args.problems):
+        contest_id = num_contests - i // 6
+        if contest_id < 1:
+            break
+        index = 'ABCDEF'[i % 6]
+        tags = rng.sample(TAGS, rng.randint(0, 5))
+        problems.append(cf.Problem(contest_id, None, index, f'Problem {contest_id}{index}',
+                                   'PROGRAMMING', None, 800 + 100 * rng.randint(0, 27), tags))
+    conn.cache_problems(problems)
+    conn.cache_problemset(problems)
+    conn.close()
+    return rating
+
+
+def generate_user_db(path, handles, rating, rng, args):
+    conn = UserDbConn(path)
+    db = conn.conn
+    num_users = max(1, int(args.members * 0.8))
+    user_ids = [FIRST_ID + i for i in range(num_users)]
+    guild_ids = [FIRST_ID + 10**9 + i for i in range(args.guilds)]
+
+    # Handles, Codeforces users and accounts on other sites.
+    user_handle, clist_accounts, gamification, members = [], [], [], set()
+    for guild_id, size in zip(guild_ids, guild_sizes(args.guilds, args.members, rng)):
+        for index in rng.sample(range(num_users), min(size, num_users)):
+            user_id = user_ids[index]
+            active = int(rng.random() < 0.9)
+            user_handle.append((str(user_id), str(guild_id), handles[index], active))
+            gamification.append((str(user_id), str(guild_id), 1500 + rng.randint(-200, 800),
+                                 rng.randint(0, 3 * 10**8)))
+            if rng.random() < 0.1:
+                clist_accounts.append((str(guild_id), str(user_id), 10**6 + index,
+                                       'atcoder.jp', handles[index]))
+            members.add(index)
+    db.executemany('INSERT INTO user_handle (user_id, guild_id, handle, active) '
+                   'VALUES (?, ?, ?, ?)', user_handle)
+    db.executemany('INSERT INTO clist_account_ids (guild_id, user_id, account_id, resource, handle) '
+                   'VALUES (?, ?, ?, ?, ?)', clist_accounts)
+    db.executemany('INSERT INTO gamification_points '
+                   '(user_id, guild_id, current_month_points, last_submission_id) '
+                   'VALUES (?, ?, ?, ?)', gamification)
+    db.executemany('INSERT INTO cf_user_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                   [(handles[index], 'First', 'Last', rng.choice(['Egypt', 'India', 'China', None]),
+                     None, None, rng.randint(-10, 100), rating.get(handles[index]),
+                     rating.get(handles[index]), LAST_CONTEST_TIME, FIRST_CONTEST_TIME, 0,
+                     'https://userpic.codeforces.org/no-title.jpg')
+                    for index in members])
+    db.executemany('INSERT INTO internal_points '
+                   '(user_id, weekly_points, monthly_points, total_points, last_solved_count) '
+                   'VALUES (?, ?, ?, ?, ?)',
+                   [(str(user_ids[index]), rng.randint(0, 50), rng.randint(0, 200),
+                     rng.randint(0, 5000), rng.randint(0, 3000)) for index in members])
+    db.commit()
+
+    # Duels between a part of the members.
+    duelists = [user_ids[index] for index in sorted(members)[:max(2, len(members) // 5)]]
+    db.executemany('INSERT INTO duelist (user_id, rating) VALUES (?, ?)',
+                   [(user_id, 1500 + rng.randint(-300, 300)) for user_id in duelists])
+    statuses = [Duel.COMPLETE] * 80 + [Duel.DECLINED] * 8 + [Duel.EXPIRED] * 6 + \
+               [Duel.WITHDRAWN] * 3 + [Duel.INVALID] * 2 + [Duel.ONGOING]
+    duels = []
+    for i in range(args.duels):
+        challenger, challengee = rng.sample(duelists, 2)
+        issue_time = FIRST_CONTEST_TIME + i * (LAST_CONTEST_TIME - FIRST_CONTEST_TIME) // args.duels
+        status = rng.choice(statuses)
+        started = status in (Duel.COMPLETE, Duel.INVALID, Duel.ONGOING)
+        finished = status in (Duel.COMPLETE, Duel.INVALID)
+        winner = rng.choice(list(Winner)) if status == Duel.COMPLETE else None
+        duels.append((challenger, challengee, issue_time, issue_time + 60 if started else None,
+                      issue_time + 3600 if finished else None, f'Problem {i % 5000}', 1 + i % 5000,
+                      'A', status, winner, rng.choice(list(DuelType))))
+    db.executemany('INSERT INTO duel (challenger, challengee, issue_time, start_time, finish_time, '
+                   'problem_name, contest_id, p_index, status, winner, type) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', duels)
+
+    # Gitgud history.
+    gitgudders = [str(user_ids[index]) for index in sorted(members)[:max(1, len(members) // 3)]]
+    challenges, score = [], {}
+    for i in range(args.challenges):
+        user_id = rng.choice(gitgudders)
+        issue_time = FIRST_CONTEST_TIME + i * (LAST_CONTEST_TIME - FIRST_CONTEST_TIME) // args.challenges
+        status = Gitgud.GOTGUD if rng.random() < 0.85 else Gitgud.NOGUD
+        delta = rng.choice([-300, -200, -100, 0, 100, 200, 300])
+        if status == Gitgud.GOTGUD:
+            score[user_id] = score.get(user_id, 0) + delta + 300
+        challenges.append((user_id, issue_time,
+                           issue_time + 3600 if status == Gitgud.GOTGUD else None,
+                           f'Problem {i % 5000}', 1 + i % 5000, 'A', delta, status))
+    db.executemany('INSERT INTO challenge (user_id, issue_time, finish_time, problem_name, '
+                   'contest_id, p_index, rating_delta, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                   challenges)
+    db.executemany('INSERT INTO user_challenge (user_id, score, num_completed, num_skipped) '
+                   'VALUES (?, ?, 0, 0)', list(score.items()))
+
+    # Rated virtual contests.
+    vc_users = []
+    for vc_id in range(1, args.rated_vcs + 1):
+        guild_id = rng.choice(guild_ids)
+        status = RatedVC.FINISHED if vc_id < args.rated_vcs else RatedVC.ONGOING
+        db.execute('INSERT INTO rated_vcs (id, contest_id, start_time, finish_time, status, guild_id) '
+                   'VALUES (?, ?, ?, ?, ?, ?)',
+                   (vc_id, 1 + vc_id % 1000, LAST_CONTEST_TIME + vc_id * 3600,
+                    LAST_CONTEST_TIME + vc_id * 3600 + 7200, status, str(guild_id)))
+        for user_id in rng.sample(duelists, min(10, len(duelists))):
+            vc_users.append((vc_id, str(user_id), 1500 + rng.randint(-300, 300)))
+    db.executemany('INSERT INTO rated_vc_users (vc_id, user_id, rating) VALUES (?, ?, ?)',
+                   vc_users)
+    db.commit()
+    conn.close()
+
+
+def generate(args):
+    os.makedirs(args.out, exist_ok=True)
+    user_db_path = os.path.join(args.out, 'user.db')
+    cache_db_path = os.path.join(args.out, 'cache.db')
+    for path in (user_db_path, cache_db_path):
+        if os.path.exists(path):
+            sys.exit(f'{path} already exists')
+    rng = random.Random(args.seed)
+    handles = [f'handle_{i}' for i in range(args.handles)]
+    begin = time.perf_counter()
+    rating = generate_cache_db(cache_db_path, handles, rng, args)
+    generate_user_db(user_db_path, handles, rating, rng, args)
+    print(f'Generated {args.out} in {time.perf_counter() - begin:.1f}s')
+
+
+# Benchmark.
+
+def sample_context(user_db, cache_db):
+    """Picks the arguments of the benchmarked methods: the biggest guild, its busiest member
+    and so on, which give the slowest case of each query."""
+    db = user_db.conn
+    guild_id, = db.execute('SELECT guild_id FROM user_handle GROUP BY guild_id '
+                           'ORDER BY COUNT(*) DESC LIMIT 1').fetchone()
+    user_id, handle = db.execute('SELECT user_id, handle FROM user_handle '
+                                 'WHERE guild_id = ? AND active = 1 LIMIT 1',
+                                 (guild_id,)).fetchone()
+    duelist, = db.execute('SELECT challenger FROM duel GROUP BY challenger '
+                          'ORDER BY COUNT(*) DESC LIMIT 1').fetchone()
+    opponent, = db.execute('SELECT challengee FROM duel WHERE challenger = ? '
+                           'GROUP BY challengee ORDER BY COUNT(*) DESC LIMIT 1',
+                           (duelist,)).fetchone()
+    gitgudder, = db.execute('SELECT user_id FROM challenge GROUP BY user_id '
+                            'ORDER BY COUNT(*) DESC LIMIT 1').fetchone()
+    guild_user_ids = [int(user_id) for user_id, in
+                      db.execute('SELECT user_id FROM user_handle WHERE guild_id = ?', (guild_id,))]
+    contest_id, = cache_db.conn.execute('SELECT MAX(contest_id) FROM rating_change').fetchone()
+    busy_handle, = cache_db.conn.execute('SELECT handle FROM rating_change GROUP BY handle '
+                                         'ORDER BY COUNT(*) DESC LIMIT 1').fetchone()
+    return {
+        'guild_id': guild_id,
+        'user_id': int(user_id),
+        'handle': handle,
+        'guild_user_ids': guild_user_ids,
+        'guild_handles': [user_db.get_handle(user_id, guild_id) for user_id in guild_user_ids],
+        'duelist': duelist,
+        'opponent': opponent,
+        'gitgudder': gitgudder,
+        'contest_id': contest_id,
+        'busy_handle': busy_handle,
+        'cf_user': user_db.fetch_cf_user(handle),
+        'problems': cache_db.fetch_problems(),
+        'contests': cache_db.fetch_contests(),
+        'rating_changes': cache_db.get_rating_changes_for_contest(contest_id),
+        'now': LAST_CONTEST_TIME,
+    }
+
+
+def user_db_benchmarks(c):
+    """(method, args) of the UserDbConn methods to time."""
+    problem = c['problems'][0]
+    return [
+        ('check_challenge', (c['gitgudder'],)),
+        ('get_gudgitters_last', (c['now'] - 30 * 24 * 60 * 60,)),
+        ('get_gudgitters_timerange', (c['now'] - 30 * 24 * 60 * 60, c['now'])),
+        ('get_gudgitters', ()),
+        ('howgud', (c['gitgudder'],)),
+        ('get_noguds', (c['gitgudder'],)),
+        ('gitlog', (c['gitgudder'],)),
+        ('new_challenge', (c['user_id'], c['now'], problem, 100)),
+        ('complete_challenge', (c['gitgudder'], -1, c['now'], 100)),
+        ('skip_challenge', (c['gitgudder'], -1, Gitgud.NOGUD)),
+        ('cache_cf_user', (c['cf_user'],)),
+        ('fetch_cf_user', (c['handle'],)),
+        ('fetch_cf_users', (c['guild_handles'],)),
+        ('set_handle', (c['user_id'], c['guild_id'], c['handle'])),
+        ('set_account_id', (c['user_id'], c['guild_id'], 1, 'atcoder.jp', c['handle'])),
+        ('set_inactive', ([(c['guild_id'], c['user_id'])],)),
+        ('get_handle', (c['user_id'], c['guild_id'])),
+        ('get_handles', (c['guild_user_ids'], c['guild_id'])),
+        ('get_account_id', (c['user_id'], c['guild_id'], 'atcoder.jp')),
+        ('get_account_ids', (c['guild_user_ids'], c['guild_id'], 'atcoder.jp')),
+        ('get_all_handles', (c['guild_id'],)),
+        ('get_account_id_by_user', (c['user_id'], c['guild_id'])),
+        ('get_user_id', (c['handle'], c['guild_id'])),
+        ('get_user_ids', (c['guild_handles'], c['guild_id'])),
+        ('remove_handle', (-1, c['guild_id'])),
+        ('get_handles_for_guild', (c['guild_id'],)),
+        ('get_account_ids_for_resource', (c['guild_id'], 'atcoder.jp')),
+        ('get_cf_users_for_guild', (c['guild_id'],)),
+        ('get_cf_user_columns_for_guild', (c['guild_id'], 'rating', 'country')),
+        ('get_reminder_settings', (c['guild_id'],)),
+        ('set_reminder_settings', (c['guild_id'], '1', '1', '[10, 60]', 'UTC', '', '')),
+        ('set_time_zone', (c['guild_id'], 'UTC')),
+        ('clear_reminder_settings', (c['guild_id'],)),
+        ('get_starboard', (c['guild_id'],)),
+        ('set_starboard', (c['guild_id'], '1')),
+        ('clear_starboard', (c['guild_id'],)),
+        # Messages are unique, so each call adds another one.
+        ('add_starboard_message', lambda i: (str(i), '2', c['guild_id'])),
+        ('check_exists_starboard_message', ('1',)),
+        ('remove_starboard_message', (), {'original_msg_id': '1'}),
+        ('clear_starboard_messages_for_guild', (c['guild_id'],)),
+        ('check_duel_challenge', (c['duelist'],)),
+        ('check_duel_accept', (c['duelist'],)),
+        ('check_duel_decline', (c['duelist'],)),
+        ('check_duel_withdraw', (c['duelist'],)),
+        ('check_duel_draw', (c['duelist'],)),
+        ('check_duel_complete', (c['duelist'],)),
+        ('create_duel', (c['duelist'], c['opponent'], c['now'], problem, DuelType.OFFICIAL)),
+        ('cancel_duel', (-1, Duel.WITHDRAWN)),
+        ('invalidate_duel', (-1,)),
+        ('start_duel', (-1, c['now'])),
+        ('complete_duel', (-1, Winner.DRAW, c['now'])),
+        ('update_duel_rating', (c['duelist'], 0)),
+        ('get_duel_wins', (c['duelist'],)),
+        ('get_duels', (c['duelist'],)),
+        ('get_duel_problem_names', (c['duelist'],)),
+        ('get_pair_duels', (c['duelist'], c['opponent'])),
+        ('update_user_points', (c['user_id'],), {'weekly_delta': 1}),
+        ('get_user_points', (c['user_id'],)),
+        ('reset_weekly_points', ()),
+        ('reset_monthly_points', ()),
+        ('get_all_points', ()),
+        ('get_recent_duels', ()),
+        ('get_ongoing_duels', ()),
+        ('get_num_duel_completed', (c['duelist'],)),
+        ('get_num_duel_draws', (c['duelist'],)),
+        ('get_num_duel_losses', (c['duelist'],)),
+        ('get_num_duel_declined', (c['duelist'],)),
+        ('get_num_duel_rdeclined', (c['duelist'],)),
+        ('get_duel_rating', (c['duelist'],)),
+        ('is_duelist', (c['duelist'],)),
+        ('register_duelist', (c['duelist'],)),
+        ('get_duelists', ()),
+        ('get_complete_official_duels', ()),
+        ('get_rankup_channel', (c['guild_id'],)),
+        ('set_rankup_channel', (c['guild_id'], '1')),
+        ('clear_rankup_channel', (c['guild_id'],)),
+        ('enable_auto_role_update', (c['guild_id'],)),
+        ('disable_auto_role_update', (c['guild_id'],)),
+        ('has_auto_role_update_enabled', (c['guild_id'],)),
+        ('reset_status', (c['guild_id'],)),
+        ('update_status', (c['guild_id'], c['guild_user_ids'][:100])),
+        ('get_rated_vc', (1,)),
+        ('get_ongoing_rated_vc_ids', ()),
+        ('get_rated_vc_user_ids', (1,)),
+        ('update_vc_rating', (1, str(c['duelist']), 1500)),
+        ('get_vc_rating', (str(c['duelist']),)),
+        ('get_vc_rating_history', (str(c['duelist']),)),
+        ('set_rated_vc_channel', (c['guild_id'], '1')),
+        ('get_rated_vc_channel', (c['guild_id'],)),
+        ('create_list', (c['guild_id'], 'bench')),
+        ('get_lists', (c['guild_id'],)),
+        ('add_to_list', ('bench', 'atcoder.jp', 1, c['handle'])),
+        ('get_list_account_ids', ('bench', 'atcoder.jp')),
+        ('get_list_handles', ('bench', 'codeforces.com')),
+        ('remove_from_list', ('bench', 'atcoder.jp', c['handle'])),
+        ('get_account_id_from_handle', (c['handle'], 'atcoder.jp')),
+        ('ban_user', (str(c['user_id']),)),
+        ('get_banned_user', (str(c['user_id']),)),
+        ('unban_user', (str(c['user_id']),)),
+    ]
+
+
+def cache_db_benchmarks(c):
+    """(method, args) of the CacheDbConn methods to time."""
+    return [
+        ('get_fingerprint', CacheDbConn._FINGERPRINT_TABLES),
+        ('cache_contests', (c['contests'],)),
+        ('fetch_contests', ()),
+        ('cache_problems', (c['problems'],)),
+        ('fetch_problems', ()),
+        ('get_tag_names', ()),
+        ('query_problem_names', (), {'tags': ['dp'], 'notags': ['math'],
+                                     'rating_min': 1600, 'rating_max': 2000}),
+        ('save_rating_changes', (c['rating_changes'],)),
+        ('save_rating_changes_batch', (c['rating_changes'], [(c['contest_id'], 0)], c['now'])),
+        ('get_contests_without_rating_changes', ()),
+        ('get_users_with_more_than_n_contests', (c['now'] - 365 * 24 * 60 * 60, 3)),
+        ('get_ratings_of_users_with_more_than_n_contests', (c['now'] - 365 * 24 * 60 * 60, 3)),
+        ('get_latest_ratings', ()),
+        ('get_rating_changes_for_contest', (c['contest_id'],)),
+        ('has_rating_changes_saved', (c['contest_id'],)),
+        ('get_rating_changes_for_handle', (c['busy_handle'],)),
+        ('get_rated_contest_ids', ()),
+        ('get_rating_change_rows_for_contest', (c['contest_id'],)),
+        ('cache_problemset', (c['problems'][:6],)),
+        ('fetch_problems2', ()),
+        ('fetch_problemset', (c['contest_id'],)),
+        ('problemset_empty', ()),
+    ]
+
+
+# Methods that are not timed, because they set up, tear down or wipe the database.
+NOT_TIMED = {'create_tables', 'close', 'backup_to', 'update', 'transaction',
+             'clear_rating_changes', 'clear_problemset', 'finish_rated_vc', 'create_rated_vc',
+             'remove_last_ratedvc_participation', 'delete_list', 'get_all_rating_changes',
+             'iter_rating_changes_by_contest'}
+
+
+def time_call(func, args, kwargs, repeat):
+    """Times `repeat` calls of `func`. `args` can also be a function of the number of the call,
+    for methods that cannot be called twice with the same arguments."""
+    times = []
+    for i in range(repeat):
+        call_args = args(i) if callable(args) else args
+        begin = time.perf_counter()
+        result = func(*call_args, **kwargs)
+        if inspect.isgenerator(result):
+            for _ in result:
+                pass
+        times.append(time.perf_counter() - begin)
+    return times
+
+
+def startup_loads(user_db, cache_db):
+    """The loads the caches do on startup, as (name, function) pairs."""
+    def replay():
+        for _ in cache_db.iter_rating_changes_by_contest():
+            pass
+
+    def all_rating_changes():
+        for _ in cache_db.get_all_rating_changes():
+            pass
+
+    return [
+        ('startup: fetch_contests', cache_db.fetch_contests),
+        ('startup: fetch_problems', cache_db.fetch_problems),
+        ('startup: fetch_problems2', cache_db.fetch_problems2),
+        ('startup: get_latest_ratings', cache_db.get_latest_ratings),
+        ('startup: iter_rating_changes_by_contest', replay),
+        ('startup: get_all_rating_changes', all_rating_changes),
+    ]
+
+
+def public_methods(cls):
+    return {name for name, _ in inspect.getmembers(cls, callable) if not name.startswith('_')}
+
+
+def run(args):
+    results = {}
+
+    def report(name, times):
+        results[name] = min(times)
+        print(f'{name:<50} {times[0] * 1000:>10.2f} {min(times) * 1000:>10.2f} '
+              f'{statistics.median(times) * 1000:>10.2f}')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Work on copies, the benchmark writes to the databases.
+        for name in ('user.db', 'cache.db'):
+            shutil.copyfile(os.path.join(args.dir, name), os.path.join(tmp_dir, name))
+        user_db = UserDbConn(os.path.join(tmp_dir, 'user.db'))
+        cache_db = CacheDbConn(os.path.join(tmp_dir, 'cache.db'))
+
+        print(f'{"":<50} {"First ms":>10} {"Min ms":>10} {"Median ms":>10}')
+        for name, func in startup_loads(user_db, cache_db):
+            report(name, time_call(func, (), {}, 1))
+
+        context = sample_context(user_db, cache_db)
+        for db, benchmarks in ((user_db, user_db_benchmarks(context)),
+                               (cache_db, cache_db_benchmarks(context))):
+            prefix = type(db).__name__
+            for method, method_args, *kwargs in benchmarks:
+                if args.only and method not in args.only:
+                    continue
+                times = time_call(getattr(db, method), method_args, kwargs[0] if kwargs else {},
+                                  args.repeat)
+                report(f'{prefix}.{method}', times)
+
+        timed = {name.split('.')[-1] for name in results}
+        untimed = ((public_methods(UserDbConn) | public_methods(CacheDbConn))
+                   - timed - NOT_TIMED - public_methods(object))
+        if untimed and not args.only:
+            print(f'Not timed, add them to the benchmark: {", ".join(sorted(untimed))}')
+        user_db.close()
+        cache_db.close()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = [(name, baseline[name], seconds) for name, seconds in results.items()
+                  if name in baseline and seconds > args.threshold * baseline[name]
+                  and seconds - baseline[name] > args.min_difference / 1000]
+        for name, before, after in slower:
+            print(f'Slower: {name} {before * 1000:.2f}ms -> {after * 1000:.2f}ms')
+        if slower:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate')
+    generate_parser.add_argument('out', help='directory to create user.db and cache.db in')
+    generate_parser.add_argument('--guilds', type=int, default=500)
+    generate_parser.add_argument('--members', type=int, default=100000,
+                                 help='number of guild memberships with a handle')
+    generate_parser.add_argument('--handles', type=int, default=400000,
+                                 help='number of Codeforces handles with rating changes')
+    generate_parser.add_argument('--rating-changes', type=int, default=5000000)
+    generate_parser.add_argument('--contest-size', type=int, default=2500,
+                                 help='average number of rated users per contest')
+    generate_parser.add_argument('--problems', type=int, default=9000)
+    generate_parser.add_argument('--duels', type=int, default=200000)
+    generate_parser.add_argument('--challenges', type=int, default=500000)
+    generate_parser.add_argument('--rated-vcs', type=int, default=2000)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.set_defaults(func=generate)
+
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('dir', help='directory with the generated user.db and cache.db')
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--only', nargs='+', help='time only these methods')
+    run_parser.add_argument('--save', help='write the results to this JSON file')
+    run_parser.add_argument('--baseline', help='compare against results saved with --save')
+    run_parser.add_argument('--threshold', type=float, default=1.5,
+                            help='report methods this many times slower than the baseline')
+    run_parser.add_argument('--min-difference', type=float, default=1.0,
+                            help='ignore slowdowns smaller than this many milliseconds')
+    run_parser.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Checks the rating calculator against official rating changes and measures its speed.
+
+    replay      Recalculates contests from the rating_change table of a cache DB, using the
+                saved old ratings and ranks, and reports the mean absolute error of the
+                predicted deltas against the official ones.
+    throughput  Reports wall time and peak memory of the calculator on random fields of
+                different sizes.
+    history     Replays the whole rating history of a cache DB with RatingReplay, either from
+                the official ratings before every contest or chaining its own ratings.
+    fixture     Copies the rating changes of some contests from a cache DB into a small DB,
+                which `replay` can then run on offline.
+
+Run from the repository root, for example
+    python extra/rating_calculator_benchmark.py replay data/db/cache.db --contests 50
+"""
+
+import argparse
+import datetime as dt
+import os
+import random
+import sqlite3
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tle.util.ranklist.rating_calculator import CodeforcesRatingCalculator
+
+DEFAULT_SIZES = (1000, 5000, 10000, 20000, 40000, 60000)
+
+
+def get_contest_ids(conn, limit, since):
+    query = ('SELECT contest_id FROM rating_change '
+             'WHERE rating_update_time >= ? '
+             'GROUP BY contest_id '
+             'ORDER BY MAX(rating_update_time) DESC')
+    res = conn.execute(query, (since,)).fetchall()
+    contest_ids = [contest_id for contest_id, in res]
+    if limit is not None:
+        contest_ids = contest_ids[:limit]
+    return contest_ids[::-1]
+
+
+def get_changes(conn, contest_id):
+    query = ('SELECT handle, rank, old_rating, new_rating FROM rating_change '
+             'WHERE contest_id = ?')
+    return conn.execute(query, (contest_id,)).fetchall()
+
+
+def replay(args):
+    conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    since = int(dt.datetime.strptime(args.since, '%Y-%m-%d').timestamp()) if args.since else 0
+    contest_ids = get_contest_ids(conn, args.contests, since)
+    if not contest_ids:
+        print('No rating changes found')
+        return
+
+    print(f'{"Contest":>8} {"Users":>6} {"MAE":>7} {"Max":>5} {"Exact":>7} {"Time":>8}')
+    total_error = total_users = total_exact = 0
+    total_time = 0.0
+    for contest_id in contest_ids:
+        changes = get_changes(conn, contest_id)
+        # Ranks are all the calculator needs from the standings, tied users share a rank.
+        standings = [(handle, -rank, 0, old_rating)
+                     for handle, rank, old_rating, _ in changes]
+        begin = time.perf_counter()
+        delta_by_handle = CodeforcesRatingCalculator(standings).calculate_rating_changes()
+        elapsed = time.perf_counter() - begin
+
+        errors = [abs(delta_by_handle[handle] - (new_rating - old_rating))
+                  for handle, _, old_rating, new_rating in changes]
+        exact = errors.count(0)
+        print(f'{contest_id:>8} {len(changes):>6} {sum(errors) / len(errors):>7.2f} '
+              f'{max(errors):>5} {exact / len(errors):>7.1%} {elapsed:>7.3f}s')
+        total_error += sum(errors)
+        total_exact += exact
+        total_users += len(errors)
+        total_time += elapsed
+
+    print(f'{len(contest_ids)} contests, {total_users} users: '
+          f'MAE {total_error / total_users:.3f}, exact {total_exact / total_users:.1%}, '
+          f'calculation time {total_time:.2f}s')
+
+
+def history(args):
+    from tle.util.db.cache_db_conn import CacheDbConn
+    from tle.util.ranklist.replay import RatingReplay
+
+    conn = CacheDbConn(args.db)
+    replay = RatingReplay(initial_rating=args.initial_rating,
+                          use_official_ratings=not args.chain)
+    begin = time.perf_counter()
+    replay.run(conn.iter_rating_changes_by_contest())
+    elapsed = time.perf_counter() - begin
+    print(f'{replay.contests_replayed} contests, {replay.num_changes} changes, '
+          f'{len(replay.index_by_handle)} handles in {elapsed:.1f}s: '
+          f'MAE {replay.mean_absolute_error:.3f}')
+
+
+def random_field(n, rng):
+    # Roughly the shape of a real round: ratings around 1400, many ties on points.
+    return [(f'user{i}', rng.randint(0, 30) * 250, rng.randint(0, 600),
+             max(0, min(4000, int(rng.gauss(1400, 350)))))
+            for i in range(n)]
+
+
+def throughput(args):
+    rng = random.Random(args.seed)
+    print(f'{"Users":>6} {"Time":>8} {"Peak memory":>12}')
+    for n in args.sizes:
+        standings = random_field(n, rng)
+        times = []
+        peak = 0
+        for _ in range(args.repeat):
+            tracemalloc.start()
+            begin = time.perf_counter()
+            CodeforcesRatingCalculator(standings).calculate_rating_changes()
+            times.append(time.perf_counter() - begin)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        print(f'{n:>6} {min(times):>7.3f}s {peak / 2**20:>9.1f} MiB')
+
+
+def fixture(args):
+    if os.path.exists(args.out):
+        sys.exit(f'{args.out} already exists')
+    src = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    contest_ids = get_contest_ids(src, args.contests, 0)
+    dst = sqlite3.connect(args.out)
+    dst.execute(
+        'CREATE TABLE rating_change ('
+        'contest_id           INTEGER NOT NULL,'
+        'handle               TEXT NOT NULL,'
+        'rank                 INTEGER,'
+        'rating_update_time   INTEGER,'
+        'old_rating           INTEGER,'
+        'new_rating           INTEGER,'
+        'UNIQUE (contest_id, handle)'
+        ')'
+    )
+    query = ('SELECT contest_id, handle, rank, rating_update_time, old_rating, new_rating '
+             'FROM rating_change WHERE contest_id = ?')
+    with dst:
+        for contest_id in contest_ids:
+            rows = src.execute(query, (contest_id,)).fetchall()
+            dst.executemany('INSERT INTO rating_change VALUES (?, ?, ?, ?, ?, ?)', rows)
+    dst.close()
+    print(f'Wrote {len(contest_ids)} contests to {args.out}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.add_argument('db', help='cache DB or fixture DB')
+    replay_parser.add_argument('--contests', type=int, help='only the latest N contests')
+    replay_parser.add_argument('--since', help='only contests rated on or after YYYY-MM-DD')
+    replay_parser.set_defaults(func=replay)
+
+    throughput_parser = subparsers.add_parser('throughput')
+    throughput_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    throughput_parser.add_argument('--repeat', type=int, default=3)
+    throughput_parser.add_argument('--seed', type=int, default=0)
+    throughput_parser.set_defaults(func=throughput)
+
+    history_parser = subparsers.add_parser('history')
+    history_parser.add_argument('db', help='cache DB or fixture DB')
+    history_parser.add_argument('--chain', action='store_true',
+                                help='carry replayed ratings over instead of using official ones')
+    history_parser.add_argument('--initial-rating', type=int, default=1500)
+    history_parser.set_defaults(func=history)
+
+    fixture_parser = subparsers.add_parser('fixture')
+    fixture_parser.add_argument('db', help='cache DB to copy from')
+    fixture_parser.add_argument('out', help='fixture DB to create')
+    fixture_parser.add_argument('--contests', type=int, default=20,
+                                help='number of latest contests to copy')
+    fixture_parser.set_defaults(func=fixture)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
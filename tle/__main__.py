@@ -1,8 +1,10 @@
 import argparse
 import asyncio
+import contextlib
 import distutils.util
 import logging
 import os
+import signal
 import discord
 from logging.handlers import TimedRotatingFileHandler
 from os import environ
@@ -11,16 +13,13 @@ from pathlib import Path
 from os import environ
 import firebase_admin
 from firebase_admin import credentials
-from firebase_admin import storage
 
 STORAGE_BUCKET = str(environ.get('STORAGE_BUCKET'))
-bucket = None
 if STORAGE_BUCKET!='None':
     cred = credentials.Certificate('firebase-admin.json')
     firebase_admin.initialize_app(cred, {
         'storageBucket': STORAGE_BUCKET
     })
-    bucket = storage.bucket()
 
 
 # Set backend to Agg before importing pyplot or seaborn to avoid crashes on headless servers
@@ -34,6 +33,7 @@ from tle import constants
 from tle.util import codeforces_common as cf_common
 from tle.util import discord_common, font_downloader
 from tle.util import clist_api
+from tle.util.db import backup
 
 
 def setup():
@@ -41,15 +41,6 @@ def setup():
     for path in constants.ALL_DIRS:
         os.makedirs(path, exist_ok=True)
     
-    # Update the user.db file from firebase
-    if bucket!=None:
-        try:
-            blob = bucket.blob('tle.db')
-            blob.download_to_filename(constants.USER_DB_FILE_PATH)
-        except:
-            # File is not present in Firebase Storage
-            pass
-
     # logging to console and file on daily interval
     logging.basicConfig(format='{asctime}:{levelname}:{name}:{message}', style='{',
                         datefmt='%d-%m-%Y %H:%M:%S', level=logging.INFO,
@@ -57,6 +48,15 @@ def setup():
                                   TimedRotatingFileHandler(constants.LOG_FILE_PATH, when='D',
                                                            backupCount=3, utc=True)])
 
+    # Update the user.db file from the backup, unless the local one is newer
+    backend = backup.backend_from_env()
+    if backend is not None:
+        try:
+            if backend.restore(constants.USER_DB_FILE_PATH):
+                logging.info('Database restored from backup')
+        except Exception as e:
+            logging.warning(f'Database could not be restored from backup. {e!r}')
+
     # matplotlib and seaborn
     plt.rcParams['figure.figsize'] = 7.0, 3.5
     sns.set()
@@ -135,9 +135,22 @@ async def main():
         asyncio.create_task(discord_common.presence(bot))
 
     bot.add_listener(discord_common.bot_error_handler, name='on_command_error')
-    
+
+    # Stop cleanly on SIGINT and SIGTERM, so that the last writes are backed up.
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            # Not supported on Windows.
+            loop.add_signal_handler(sig, lambda: asyncio.create_task(bot.close()))
+
     # Start the bot
-    await bot.start(token)
+    try:
+        await bot.start(token)
+    finally:
+        if not bot.is_closed():
+            await bot.close()
+        cf_common.close()
+        logging.info('Shut down')
 
 
 if __name__ == '__main__':
@@ -6,6 +6,7 @@ from discord.ext import commands
 
 from tle import constants
 from tle.util import codeforces_common as cf_common
+from tle.util import table
 
 
 def timed_command(coro):
@@ -26,6 +27,9 @@ class CacheControl(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+    async def cog_before_invoke(self, ctx):
+        await cf_common.cache2.wait_until_ready()
+
     @commands.group(brief='Commands to force reload of cache',
                     invoke_without_command=True, hidden=True)
     @commands.check_any(commands.has_role('Admin'), commands.is_owner())
@@ -50,18 +54,27 @@ class CacheControl(commands.Cog):
     async def ratingchanges(self, ctx, contest_id='missing'):
         """Defaults to 'missing'. Mode 'all' clears existing cached changes.
         Mode 'contest_id' clears existing changes with the given contest id.
+        Progress is saved after every batch, so an interrupted run can be
+        resumed with mode 'missing'.
         """
         if contest_id not in ('all', 'missing'):
             try:
                 contest_id = int(contest_id)
             except ValueError:
                 return
-        if contest_id == 'all':
-            await ctx.send('This will take a while')
-            count = await cf_common.cache2.rating_changes_cache.fetch_all_contests()
-        elif contest_id == 'missing':
-            await ctx.send('This may take a while')
-            count = await cf_common.cache2.rating_changes_cache.fetch_missing_contests()
+        if contest_id in ('all', 'missing'):
+            message = await ctx.send('This will take a while' if contest_id == 'all'
+                                     else 'This may take a while')
+
+            async def progress(done, total, changes):
+                await message.edit(content=f'Fetched {done}/{total} contests, '
+                                           f'{changes} changes saved')
+
+            cache = cf_common.cache2.rating_changes_cache
+            if contest_id == 'all':
+                count = await cache.fetch_all_contests(progress)
+            else:
+                count = await cache.fetch_missing_contests(progress)
         else:
             count = await cf_common.cache2.rating_changes_cache.fetch_contest(contest_id)
         await ctx.send(f'Done, fetched {count} changes and recached handle ratings')
@@ -84,6 +97,32 @@ class CacheControl(commands.Cog):
             count = await cf_common.cache2.problemset_cache.update_for_contest(contest_id)
         await ctx.send(f'Done, fetched {count} problems')
 
+    @cache.command()
+    @commands.check_any(commands.has_role('Admin'), commands.is_owner())
+    async def stats(self, ctx):
+        """Shows refresh, lookup and lock statistics of every cache."""
+        now = time.time()
+
+        def fmt_seconds(seconds):
+            return '-' if seconds is None else f'{seconds:.2f}s'
+
+        style = table.Style('{:<}  {:>}  {:>}  {:>}  {:>}  {:>}  {:>}  {:>}')
+        t = table.Table(style)
+        t += table.Header('Cache', 'Refreshed', 'Took', 'Rows', 'Memory', 'Lookups', 'Misses',
+                          'Lock wait')
+        t += table.Line()
+        for cache in cf_common.cache2.caches:
+            stats = cache.stats
+            refreshed = ('never' if stats.last_refresh is None else
+                         cf_common.pretty_time_format(now - stats.last_refresh, shorten=True,
+                                                      only_most_significant=True) + ' ago')
+            rows = '-' if stats.rows_changed is None else stats.rows_changed
+            memory = f'{cache.memory_estimate() / 2**20:.1f}MB'
+            t += table.Data(cache.__class__.__name__, refreshed,
+                            fmt_seconds(stats.refresh_duration), rows, memory, stats.lookups,
+                            stats.misses, fmt_seconds(stats.lock_wait))
+        await ctx.send(f'```\n{t}\n```')
+
 
 async def setup(bot):
     await bot.add_cog(CacheControl(bot))
@@ -112,6 +112,10 @@ class Codeforces(commands.Cog):
         self.font = ImageFont.truetype(constants.NOTO_SANS_CJK_BOLD_FONT_PATH, size=26)
         self.converter = commands.MemberConverter()
 
+    async def cog_before_invoke(self, ctx):
+        await cf_common.cache_ready('contest_cache', 'problem_cache', 'problemset_cache',
+                                    'rating_changes_cache')
+
     async def _validate_gitgud_status(self, ctx, delta):
         if delta is not None and delta % 100 != 0:
             raise CodeforcesCogError('Delta must be a multiple of 100.')
@@ -152,7 +156,7 @@ class Codeforces(commands.Cog):
         handle, = await cf_common.resolve_handles(ctx, self.converter, ('!' + str(ctx.author),))
         user = cf_common.user_db.fetch_cf_user(handle)
         rating = round(user.effective_rating, -2)
-        resp = await cf.user.rating(handle=handle)
+        resp = await cf_common.cache2.rating_changes_cache.get_rating_history(handle)
         contests = {change.contestId for change in resp}
         submissions = await cf.user.status(handle=handle)
         solved = {sub.problem.name for sub in submissions if sub.verdict == 'OK'}
@@ -206,13 +210,11 @@ class Codeforces(commands.Cog):
         submissions = await cf.user.status(handle=handle)
         solved = {sub.problem.name for sub in submissions if sub.verdict == 'OK'}
 
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if prob.rating == rating and prob.name not in solved and
+        problems = await cf_common.cache2.problem_cache.query(tags=tags, notags=notags,
+                                                              rating_min=rating, rating_max=rating)
+        problems = [prob for prob in problems
+                    if prob.name not in solved and
                     not cf_common.is_contest_writer(prob.contestId, handle)]
-        if tags:
-            problems = [prob for prob in problems if prob.tag_matches(tags)]
-        if notags:
-            problems = [prob for prob in problems if (prob.tag_matches_or(notags) == None)]
 
         if not problems:
             raise CodeforcesCogError('Problems not found within the search parameters')
@@ -353,12 +355,12 @@ class Codeforces(commands.Cog):
         rating += delta
         rating = max(800, rating)
         rating = min(3500, rating)
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if abs(prob.rating - rating) <= 300 and prob.name not in solved
+        problems = await cf_common.cache2.problem_cache.query(tags=tags, rating_min=rating - 300,
+                                                              rating_max=rating + 300)
+        problems = [prob for prob in problems
+                    if prob.name not in solved
                     and not any(cf_common.is_contest_writer(prob.contestId, handle) for handle in handles)
                     and not cf_common.is_nonstandard_problem(prob)]
-        if tags:
-            problems = [prob for prob in problems if prob.tag_matches(tags)]
 
         if len(problems) < 4:
             raise CodeforcesCogError('Problems not found within the search parameters')
@@ -649,8 +651,11 @@ class Codeforces(commands.Cog):
             return user.maxRating if peak else user.rating
 
         if is_entire_server:
-            res = cf_common.user_db.get_cf_users_for_guild(ctx.guild.id)
-            ratings = [(rating(user), 1) for user_id, user in res if user.rating is not None]
+            _, current_ratings, max_ratings = cf_common.user_db.get_cf_user_columns_for_guild(
+                ctx.guild.id, 'rating', 'maxRating')
+            ratings = [(max_rating if peak else current_rating, 1)
+                       for current_rating, max_rating in zip(current_ratings, max_ratings)
+                       if current_rating is not None]
             user_str = '+server'
         else:
             def normalize(x):
@@ -131,9 +131,13 @@ class Contests(commands.Cog):
 
         self.logger = logging.getLogger(self.__class__.__name__)
 
+    async def cog_before_invoke(self, ctx):
+        await cf_common.cache_ready('contest_cache', 'ranklist_cache')
+
     @commands.Cog.listener()
     @discord_common.once
     async def on_ready(self):
+        await cf_common.cache_ready('contest_cache', 'ranklist_cache')
         self._watch_rated_vcs_task.start()
     
     @staticmethod
@@ -583,10 +587,8 @@ class Contests(commands.Cog):
             raise ContestCogError('No ranklist to show')
 
         handle_standings = []
-        for handle in handles:
-            try:
-                standing = ranklist.get_standing_row(handle)
-            except rl.HandleNotPresentError:
+        for standing in ranklist.get_standing_rows(handles):
+            if standing is None:
                 continue
 
             # Database has correct handle ignoring case, update to it
@@ -722,7 +724,7 @@ class Contests(commands.Cog):
             raise ContestCogError('No Rated VC channel')
         channel = self.bot.get_channel(int(channel_id))
         member_ids = cf_common.user_db.get_rated_vc_user_ids(vc_id)
-        handles = [cf_common.user_db.get_handle(member_id, channel.guild.id) for member_id in member_ids]
+        handles = cf_common.user_db.get_handles(member_ids, channel.guild.id)
         handle_to_member_id = {handle : member_id for handle, member_id in zip(handles, member_ids)}
         now = time.time()
         ranklist = await cf_common.cache2.ranklist_cache.generate_vc_ranklist(vc.contest_id, handle_to_member_id)
@@ -57,6 +57,9 @@ class Dueling(commands.Cog):
         self.bot = bot
         self.converter = commands.MemberConverter()
 
+    async def cog_before_invoke(self, ctx):
+        await cf_common.cache_ready('problem_cache')
+
     def _get_advanced_data(self, duel_id):
         query = 'SELECT problem_names, challenger_completed, challengee_completed FROM advanced_duel_data WHERE duel_id = ?'
         return cf_common.user_db._fetchone(query, (duel_id,))
@@ -86,10 +89,10 @@ class Dueling(commands.Cog):
              raise DuelCogError(f'**{opponent.display_name}** is already in a duel!')
 
         userids = [challenger_id, challengee_id]
-        handles = [cf_common.user_db.get_handle(uid, ctx.guild.id) for uid in userids]
+        handles = cf_common.user_db.get_handles(userids, ctx.guild.id)
         submissions = [await cf.user.status(handle=h) for h in handles]
         
-        users = [cf_common.user_db.fetch_cf_user(h) for h in handles]
+        users = cf_common.user_db.fetch_cf_users(handles)
         lowest_rating = min(u.rating or 0 for u in users)
         suggested_rating = max(round(lowest_rating, -2) + _DUEL_RATING_DELTA, 800)
         rating = round(rating, -2) if rating else suggested_rating
@@ -117,13 +120,12 @@ class Dueling(commands.Cog):
         problem_names = ",".join([p.name for p in problems_to_use])
         issue_time = datetime.datetime.now().timestamp()
         
-        duel_id = cf_common.user_db.create_duel(challenger_id, challengee_id, issue_time, problems_to_use[0], DuelType.OFFICIAL)
-        
-        cf_common.user_db.conn.execute(
-            'INSERT INTO advanced_duel_data (duel_id, problem_names) VALUES (?, ?)',
-            (duel_id, problem_names)
-        )
-        cf_common.user_db.conn.commit()
+        with cf_common.user_db.transaction():
+            duel_id = cf_common.user_db.create_duel(challenger_id, challengee_id, issue_time, problems_to_use[0], DuelType.OFFICIAL)
+            cf_common.user_db.conn.execute(
+                'INSERT INTO advanced_duel_data (duel_id, problem_names) VALUES (?, ?)',
+                (duel_id, problem_names)
+            )
 
         await ctx.send(f'{ctx.author.mention} challenged {opponent.mention} to a duel of {num_probs} problems! (Rating: {rating})')
         
@@ -205,22 +207,27 @@ class Dueling(commands.Cog):
             winner, win_status = None, Winner.DRAW
         
         finish_time = datetime.datetime.now().timestamp()
-        cf_common.user_db.conn.execute('UPDATE duel SET status = ?, finish_time = ?, winner = ? WHERE id = ?', 
-                                     (Duel.COMPLETE, finish_time, win_status, duel_id))
-        cf_common.user_db.conn.commit()
+        # The result and the points change together.
+        with cf_common.user_db.transaction():
+            cf_common.user_db.conn.execute('UPDATE duel SET status = ?, finish_time = ?, winner = ? WHERE id = ?', 
+                                         (Duel.COMPLETE, finish_time, win_status, duel_id))
+            if winner:
+                diff = win_score - lose_score
+                cf_common.user_db.conn.execute(
+                    "UPDATE gamification_points SET current_month_points = current_month_points + ? WHERE user_id = ? AND guild_id = ?",
+                    (win_score, str(winner.id), str(ctx.guild.id))
+                )
+                cf_common.user_db.conn.execute(
+                    "UPDATE gamification_points SET current_month_points = current_month_points - ? WHERE user_id = ? AND guild_id = ?",
+                    (diff, str(loser.id), str(ctx.guild.id))
+                )
+            elif score_a > 0:
+                cf_common.user_db.conn.execute(
+                    "UPDATE gamification_points SET current_month_points = current_month_points + ? WHERE (user_id = ? OR user_id = ?) AND guild_id = ?",
+                    (score_a, str(challenger_id), str(challengee_id), str(ctx.guild.id))
+                )
 
         if winner:
-            diff = win_score - lose_score
-            cf_common.user_db.conn.execute(
-                "UPDATE gamification_points SET current_month_points = current_month_points + ? WHERE user_id = ? AND guild_id = ?",
-                (win_score, str(winner.id), str(ctx.guild.id))
-            )
-            cf_common.user_db.conn.execute(
-                "UPDATE gamification_points SET current_month_points = current_month_points - ? WHERE user_id = ? AND guild_id = ?",
-                (diff, str(loser.id), str(ctx.guild.id))
-            )
-            cf_common.user_db.conn.commit()
-            
             embed = discord_common.embed_success(f"🏆 **{winner.display_name}** won the duel!")
             embed.add_field(name="Final Results", value=f"{challenger.display_name}: **{score_a}**\n{challengee.display_name}: **{score_b}**")
             embed.add_field(name="Points Impact", value=f"**{winner.display_name}**: +{win_score}\n**{loser.display_name}**: -{diff}")
@@ -228,11 +235,6 @@ class Dueling(commands.Cog):
             embed = discord_common.embed_success(f"🤝 The duel ended in a Draw!")
             embed.add_field(name="Final Results", value=f"Both Players: **{score_a}**")
             if score_a > 0:
-                cf_common.user_db.conn.execute(
-                    "UPDATE gamification_points SET current_month_points = current_month_points + ? WHERE (user_id = ? OR user_id = ?) AND guild_id = ?",
-                    (score_a, str(challenger_id), str(challengee_id), str(ctx.guild.id))
-                )
-                cf_common.user_db.conn.commit()
                 embed.add_field(name="Points Impact", value=f"Both Players: +{score_a}")
             else:
                 embed.add_field(name="Points Impact", value="No points awarded (No problems solved)")
@@ -230,6 +230,9 @@ class Graphs(commands.Cog):
         self.bot = bot
         self.converter = commands.MemberConverter()
 
+    async def cog_before_invoke(self, ctx):
+        await cf_common.cache_ready('contest_cache', 'rating_changes_cache', 'problemset_cache')
+
     @commands.group(brief='Graphs for analyzing Codeforces activity',
                     invoke_without_command=True)
     async def plot(self, ctx):
@@ -438,7 +441,8 @@ class Graphs(commands.Cog):
         if resource=='codeforces.com':
             handles = args or ('!' + str(ctx.author),)
             handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-            resp = [await cf.user.rating(handle=handle) for handle in handles]
+            resp = [await cf_common.cache2.rating_changes_cache.get_rating_history(handle)
+                    for handle in handles]
             if not any(resp):
                 handles_str = ', '.join(f'`{handle}`' for handle in handles)
                 if len(handles) == 1:
@@ -535,7 +539,8 @@ class Graphs(commands.Cog):
         if resource=='codeforces.com':
             handles = args or ('!' + str(ctx.author),)
             handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-            resp = [await cf.user.rating(handle=handle) for handle in handles]
+            resp = [await cf_common.cache2.rating_changes_cache.get_rating_history(handle)
+                    for handle in handles]
             if not any(resp):
                 handles_str = ', '.join(f'`{handle}`' for handle in handles)
                 if len(handles) == 1:
@@ -615,7 +620,7 @@ class Graphs(commands.Cog):
 
         handles = args or ('!' + str(ctx.author),)
         handle, = await cf_common.resolve_handles(ctx, self.converter, handles)
-        ratingchanges = await cf.user.rating(handle=handle)
+        ratingchanges = await cf_common.cache2.rating_changes_cache.get_rating_history(handle)
         if not ratingchanges:
             raise GraphCogError(f'User {handle} is not rated')
 
@@ -837,7 +842,7 @@ class Graphs(commands.Cog):
 
         handle = handle or '!' + str(ctx.author)
         handle, = await cf_common.resolve_handles(ctx, self.converter, (handle,))
-        rating_resp = [await cf.user.rating(handle=handle)]
+        rating_resp = [await cf_common.cache2.rating_changes_cache.get_rating_history(handle)]
         rating_resp = [filt.filter_rating_changes(rating_changes) for rating_changes in rating_resp]
         submissions = filt.filter_subs(await cf.user.status(handle=handle))
 
@@ -942,9 +947,10 @@ class Graphs(commands.Cog):
             member = ctx.guild.get_member(int(userid))
             return not member or 'Purgatory' in {role.name for role in member.roles}
 
-        res = cf_common.user_db.get_cf_users_for_guild(ctx.guild.id)
-        ratings = [cf_user.rating for user_id, cf_user in res
-                   if cf_user.rating is not None and not in_purgatory(user_id)]
+        user_ids, ratings = cf_common.user_db.get_cf_user_columns_for_guild(ctx.guild.id,
+                                                                            'rating')
+        ratings = [rating for user_id, rating in zip(user_ids, ratings)
+                   if rating is not None and not in_purgatory(user_id)]
         await self._rating_hist(ctx,
                                 ratings,
                                 'normal',
@@ -961,11 +967,10 @@ class Graphs(commands.Cog):
             raise GraphCogError('Activity should be either `active` or `all`')
 
         time_cutoff = int(time.time()) - CONTEST_ACTIVE_TIME_CUTOFF if activity == 'active' else 0
-        handles = cf_common.cache2.rating_changes_cache.get_users_with_more_than_n_contests(time_cutoff, contest_cutoff)
-        if not handles:
+        ratings = await cf_common.cache2.rating_changes_cache.get_ratings_of_users_with_more_than_n_contests(time_cutoff, contest_cutoff)
+        if not ratings:
             raise GraphCogError('No Codeforces users meet the specified criteria')
 
-        ratings = [cf_common.cache2.rating_changes_cache.get_current_rating(handle) for handle in handles]
         title = f'Rating distribution of {activity} Codeforces users ({mode} scale)'
         await self._rating_hist(ctx,
                                 ratings,
@@ -981,8 +986,7 @@ class Graphs(commands.Cog):
         intervals = [(rank.low, rank.high) for rank in cf.RATED_RANKS]
         colors = [rank.color_graph for rank in cf.RATED_RANKS]
 
-        ratings = cf_common.cache2.rating_changes_cache.get_all_ratings()
-        ratings = np.array(sorted(ratings))
+        ratings = np.array(cf_common.cache2.rating_changes_cache.get_sorted_ratings())
         n = len(ratings)
         perc = 100*np.arange(n)/n
 
@@ -1123,8 +1127,9 @@ class Graphs(commands.Cog):
         if len(countries) > max_countries:
             raise GraphCogError(f'At most {max_countries} countries may be specified.')
 
-        users = cf_common.user_db.get_cf_users_for_guild(ctx.guild.id)
-        counter = collections.Counter(user.country for _, user in users if user.country)
+        _, user_countries = cf_common.user_db.get_cf_user_columns_for_guild(ctx.guild.id,
+                                                                            'country')
+        counter = collections.Counter(country for country in user_countries if country)
 
         if not countries:
             # list because seaborn complains for tuple.
@@ -342,10 +342,14 @@ class Handles(commands.Cog):
         self.font = ImageFont.truetype(constants.NOTO_SANS_CJK_BOLD_FONT_PATH, size=26) # font for ;handle pretty
         self.converter = commands.MemberConverter()
 
+    async def cog_before_invoke(self, ctx):
+        await cf_common.cache_ready('contest_cache', 'problem_cache', 'rating_changes_cache')
+
     @commands.Cog.listener()
     @discord_common.once
     async def on_ready(self):
         cf_common.event_sys.add_listener(self._on_rating_changes)
+        await cf_common.cache_ready('contest_cache', 'problem_cache', 'rating_changes_cache')
         self._set_ex_users_inactive_task.start()
         self._update_clist_users_cache.start()
 
@@ -367,9 +371,9 @@ class Handles(commands.Cog):
     async def _updatestatus(self, ctx):
         gid = ctx.guild.id
         active_ids = [m.id for m in ctx.guild.members]
-        cf_common.user_db.reset_status(gid)
-        rc = sum(cf_common.user_db.update_status(gid, chunk) for chunk in paginator.chunkify(active_ids, 100))
-        cf_common.user_db.update()
+        with cf_common.user_db.transaction():
+            cf_common.user_db.reset_status(gid)
+            rc = sum(cf_common.user_db.update_status(gid, chunk) for chunk in paginator.chunkify(active_ids, 100))
         await ctx.send(f'{rc} members active with handle')
 
     @commands.Cog.listener()
@@ -394,6 +398,7 @@ class Handles(commands.Cog):
                           event_cls=events.RatingChangesUpdate,
                           with_lock=True)
     async def _on_rating_changes(self, event):
+        await cf_common.cache_ready('contest_cache', 'problem_cache', 'rating_changes_cache')
         contest, changes = event.contest, event.rating_changes
         change_by_handle = {change.handle: change for change in changes}
 
@@ -727,13 +732,14 @@ class Handles(commands.Cog):
         
         rankings = []
         index = 0
-        for user_id, score in sorted(res.items(), key=lambda item: item[1], reverse=True):
+        res = sorted(res.items(), key=lambda item: item[1], reverse=True)
+        handles = cf_common.user_db.get_handles([user_id for user_id, score in res], ctx.guild.id)
+        users = cf_common.user_db.fetch_cf_users(handles)
+        for (user_id, score), handle, user in zip(res, handles, users):
             member = ctx.guild.get_member(int(user_id))
             if member is None:
                 continue
             if score > 0:
-                handle = cf_common.user_db.get_handle(user_id, ctx.guild.id)
-                user = cf_common.user_db.fetch_cf_user(handle)
                 if user is None:
                     continue
                 discord_handle = member.display_name
@@ -756,13 +762,13 @@ class Handles(commands.Cog):
 
         rankings = []
         index = 0
-        for user_id, score in res:
+        handles = cf_common.user_db.get_handles([user_id for user_id, score in res], ctx.guild.id)
+        users = cf_common.user_db.fetch_cf_users(handles)
+        for (user_id, score), handle, user in zip(res, handles, users):
             member = ctx.guild.get_member(int(user_id))
             if member is None:
                 continue
             if score > 0:
-                handle = cf_common.user_db.get_handle(user_id, ctx.guild.id)
-                user = cf_common.user_db.fetch_cf_user(handle)
                 if user is None:
                     continue
                 discord_handle = member.display_name
@@ -820,13 +826,14 @@ class Handles(commands.Cog):
         rankings = []
         index = 0
         cache = cf_common.cache2.rating_changes_cache
-        for user_id, score in sorted(res.items(), key=lambda item: item[1], reverse=True):
+        res = sorted(res.items(), key=lambda item: item[1], reverse=True)
+        handles = cf_common.user_db.get_handles([user_id for user_id, score in res], ctx.guild.id)
+        users = cf_common.user_db.fetch_cf_users(handles)
+        for (user_id, score), handle, user in zip(res, handles, users):
             member = ctx.guild.get_member(int(user_id))
             if member is None:
                 continue
             if score > 0:
-                handle = cf_common.user_db.get_handle(user_id, ctx.guild.id)
-                user = cf_common.user_db.fetch_cf_user(handle)
                 if user is None:
                     continue
                 rating = user.rating
@@ -54,11 +54,10 @@ class Scoring(commands.Cog):
                     res = cf_common.user_db._fetchone(query, (str(user_id), str(guild.id)))
                     
                     if not res:
-                        cf_common.user_db.conn.execute(
+                        cf_common.user_db.group_commit.execute(
                             "INSERT INTO gamification_points (user_id, guild_id, current_month_points, last_submission_id) VALUES (?, ?, 1500, 0)",
                             (str(user_id), str(guild.id))
                         )
-                        cf_common.user_db.conn.commit()
                         last_id, current_points = 0, 1500
                     else:
                         last_id, current_points = res.last_submission_id, res.current_month_points
@@ -92,8 +91,7 @@ class Scoring(commands.Cog):
                     
                     if new_points > 0 or max_sub_id > last_id:
                         query = "UPDATE gamification_points SET current_month_points = current_month_points + ?, last_submission_id = ? WHERE user_id = ? AND guild_id = ?"
-                        cf_common.user_db.conn.execute(query, (new_points, max_sub_id, str(user_id), str(guild.id)))
-                        cf_common.user_db.conn.commit()
+                        cf_common.user_db.group_commit.execute(query, (new_points, max_sub_id, str(user_id), str(guild.id)))
 
             except Exception as e:
                 self.logger.error(f"Error in check_submissions: {e}")
@@ -7,6 +7,7 @@ ASSETS_DIR = os.path.join(DATA_DIR, 'assets')
 DB_DIR = os.path.join(DATA_DIR, 'db')
 MISC_DIR = os.path.join(DATA_DIR, 'misc')
 TEMP_DIR = os.path.join(DATA_DIR, 'temp')
+CACHE_SNAPSHOT_DIR = os.path.join(DATA_DIR, 'snapshot')
 
 USER_DB_FILE_PATH = os.path.join(DB_DIR, 'user.db')
 CACHE_DB_FILE_PATH = os.path.join(DB_DIR, 'cache.db')
@@ -0,0 +1,81 @@
+"""
+    Binary snapshots of the in-memory structures derived from the cache database.
+
+    Building these structures from SQLite means reading and converting every row, which is slow
+    for large tables. A snapshot stores the finished structures together with a fingerprint of
+    the tables they were built from. The database stays the source of truth: a snapshot is only
+    used if its format version and fingerprint match, otherwise the caller rebuilds from the
+    database and writes a new snapshot.
+"""
+
+import logging
+import os
+import pickle
+import struct
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'TLESNAP'
+# Bump this whenever the layout of any snapshotted structure changes.
+_VERSION = 1
+_HEADER = struct.Struct(f'<{len(_MAGIC)}sI')
+
+
+class CacheSnapshot:
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+
+    def _path(self, name):
+        return os.path.join(self.snapshot_dir, f'{name}.snap')
+
+    def names(self, prefix=''):
+        """Returns the names of all saved snapshots starting with `prefix`."""
+        try:
+            filenames = os.listdir(self.snapshot_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(filename[:-len('.snap')] for filename in filenames
+                      if filename.startswith(prefix) and filename.endswith('.snap'))
+
+    def load(self, name, fingerprint):
+        """Returns the data saved under `name`, or None if there is no usable snapshot for the
+        given fingerprint.
+        """
+        try:
+            with open(self._path(name), 'rb') as f:
+                buffer = f.read()
+            magic, version = _HEADER.unpack_from(buffer)
+            if magic != _MAGIC or version != _VERSION:
+                logger.info(f'Snapshot `{name}` has an unsupported format, ignoring.')
+                return None
+            saved_fingerprint, data = pickle.loads(memoryview(buffer)[_HEADER.size:])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error, pickle.UnpicklingError, EOFError) as e:
+            logger.warning(f'Snapshot `{name}` could not be read, ignoring. {e!r}')
+            return None
+        if saved_fingerprint != fingerprint:
+            logger.info(f'Snapshot `{name}` is stale, ignoring.')
+            return None
+        return data
+
+    def save(self, name, fingerprint, data):
+        path = self._path(name)
+        tmp_path = f'{path}.tmp'
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, _VERSION))
+                pickle.dump((fingerprint, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+            # Replace atomically so that a crash never leaves a half-written snapshot.
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'Snapshot `{name}` could not be written. {e!r}')
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f'Snapshot `{name}` could not be deleted. {e!r}')
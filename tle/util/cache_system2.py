@@ -1,5 +1,9 @@
 import asyncio
+import contextlib
+import itertools
 import logging
+import random
+import sys
 import time
 from aiocache import cached
 
@@ -8,10 +12,13 @@ from discord.ext import commands
 
 from tle.util import codeforces_common as cf_common
 from tle.util import codeforces_api as cf
+from tle.util import db
 from tle.util import events
 from tle.util import tasks
 from tle.util import paginator
 from tle.util.ranklist import Ranklist
+from tle.util.ranklist.prediction import PredictionService
+from tle.util.ranklist.replay import RatingReplay
 
 logger = logging.getLogger(__name__)
 _CONTESTS_PER_BATCH_IN_CACHE_UPDATES = 100
@@ -20,6 +27,61 @@ CONTEST_BLACKLIST = {1308, 1309, 1431, 1432, 1522, 1531}
 def _is_blacklisted(contest):
     return contest.id in CONTEST_BLACKLIST
 
+def _approx_size(obj, sample_size=50):
+    """Rough estimate in bytes of the memory taken by `obj` and the objects it refers to. Large
+    containers are extrapolated from a sample of their elements and shared objects are counted
+    once per reference.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        sample = list(itertools.islice(obj.items(), sample_size))
+        if sample:
+            per_item = sum(_approx_size(k) + _approx_size(v) for k, v in sample) / len(sample)
+            size += per_item * len(obj)
+        return int(size)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        sample = list(itertools.islice(obj, sample_size))
+        if sample:
+            size += sum(map(_approx_size, sample)) / len(sample) * len(obj)
+        return int(size)
+    if hasattr(obj, '__dict__'):
+        size += _approx_size(vars(obj))
+    return size
+
+
+class CacheStats:
+    """Performance counters of a cache, shown by `;cache stats`."""
+
+    def __init__(self):
+        self.last_refresh = None
+        self.refresh_duration = None
+        self.rows_changed = None
+        self.lookups = 0
+        self.misses = 0
+        self.lock_wait = 0.0
+
+    def record_refresh(self, begin, rows_changed):
+        now = time.time()
+        self.last_refresh = now
+        self.refresh_duration = now - begin
+        self.rows_changed = rows_changed
+
+    def record_lookup(self, hit=True):
+        self.lookups += 1
+        if not hit:
+            self.misses += 1
+
+    @contextlib.asynccontextmanager
+    async def locked(self, lock):
+        """Acquires `lock`, adding the time spent waiting for it to the lock wait total."""
+        begin = time.perf_counter()
+        async with lock:
+            self.lock_wait += time.perf_counter() - begin
+            yield
+
+
 class CacheError(commands.CommandError):
     pass
 
@@ -54,11 +116,17 @@ class ContestCache:
         self.reload_lock = asyncio.Lock()
         self.reload_exception = None
         self.next_delay = None
+        # Set once the cache has been loaded from disk.
+        self.ready = asyncio.Event()
+        self.stats = CacheStats()
 
         self.logger = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
-        await self._try_disk()
+        try:
+            await self._try_disk()
+        finally:
+            self.ready.set()
         self._update_task.start()
 
     async def reload_now(self):
@@ -77,9 +145,12 @@ class ContestCache:
 
     def get_contest(self, contest_id):
         try:
-            return self.contest_by_id[contest_id]
+            contest = self.contest_by_id[contest_id]
         except KeyError:
+            self.stats.record_lookup(hit=False)
             raise ContestNotFound(contest_id)
+        self.stats.record_lookup()
+        return contest
 
     def get_problemset(self, contest_id):
         return self.cache_master.conn.get_problemset_from_contest(contest_id)
@@ -87,8 +158,11 @@ class ContestCache:
     def get_contests_in_phase(self, phase):
         return self.contests_by_phase[phase]
 
+    def memory_estimate(self):
+        return _approx_size((self.contests, self.contest_by_id, self.contests_by_phase))
+
     async def _try_disk(self):
-        async with self.reload_lock:
+        async with self.stats.locked(self.reload_lock):
             contests = self.cache_master.conn.fetch_contests()
             if not contests:
                 self.logger.info('Contest cache on disk is empty.')
@@ -97,7 +171,7 @@ class ContestCache:
 
     @tasks.task_spec(name='ContestCacheUpdate')
     async def _update_task(self, _):
-        async with self.reload_lock:
+        async with self.stats.locked(self.reload_lock):
             self.next_delay = await self._reload_contests()
         self.reload_exception = None
 
@@ -116,11 +190,13 @@ class ContestCache:
         return delay
 
     async def _update(self, contests, from_api=True):
+        begin = time.time()
         self.logger.info(f'{len(contests)} contests fetched from {"API" if from_api else "disk"}')
         contests.sort(key=lambda contest: (contest.startTimeSeconds, contest.id))
 
+        rc = len(contests)
         if from_api:
-            rc = self.cache_master.conn.cache_contests(contests)
+            rc = await self.cache_master.conn.aio.cache_contests(contests)
             self.logger.info(f'{rc} contests stored in database')
 
         contests_by_phase = {phase: [] for phase in cf.Contest.PHASES}
@@ -153,6 +229,7 @@ class ContestCache:
         self.contests_by_phase = contests_by_phase
         self.contest_by_id = contest_by_id
         self.contests_last_cache = time.time()
+        self.stats.record_refresh(begin, rc)
 
         cf_common.event_sys.dispatch(events.ContestListRefresh, self.contests.copy())
 
@@ -171,11 +248,16 @@ class ProblemCache:
 
         self.reload_lock = asyncio.Lock()
         self.reload_exception = None
+        self.ready = asyncio.Event()
+        self.stats = CacheStats()
 
         self.logger = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
-        await self._try_disk()
+        try:
+            await self._try_disk()
+        finally:
+            self.ready.set()
         self._update_task.start()
 
     async def reload_now(self):
@@ -192,20 +274,37 @@ class ProblemCache:
         if self.reload_exception:
             raise self.reload_exception
 
+    def memory_estimate(self):
+        return _approx_size((self.problems, self.problem_by_name))
+
+    async def query(self, *, tags=(), notags=(), rating_min=None, rating_max=None):
+        """Returns the problems with a rating in the given range, matching all of `tags` and
+        none of `notags`. The filtering is done by the database."""
+        names = await self.cache_master.conn.aio.query_problem_names(
+            tags=tags, notags=notags, rating_min=rating_min, rating_max=rating_max)
+        return [self.problem_by_name[name] for name in names if name in self.problem_by_name]
+
     async def _try_disk(self):
-        async with self.reload_lock:
-            problems = self.cache_master.conn.fetch_problems()
+        async with self.stats.locked(self.reload_lock):
+            begin = time.time()
+            fingerprint = self.cache_master.conn.get_fingerprint('problem')
+            problems = self.cache_master.load_snapshot('problems', fingerprint)
+            if problems is None:
+                problems = self.cache_master.conn.fetch_problems()
+                if problems:
+                    self.cache_master.save_snapshot('problems', fingerprint, problems)
             if not problems:
                 self.logger.info('Problem cache on disk is empty.')
                 return
             self.problems = problems
             self.problem_by_name = {problem.name: problem for problem in problems}
+            self.stats.record_refresh(begin, len(problems))
             self.logger.info(f'{len(self.problems)} problems fetched from disk')
 
     @tasks.task_spec(name='ProblemCacheUpdate',
                      waiter=tasks.Waiter.fixed_delay(_RELOAD_INTERVAL))
     async def _update_task(self, _):
-        async with self.reload_lock:
+        async with self.stats.locked(self.reload_lock):
             await self._reload_problems()
         self.reload_exception = None
 
@@ -218,6 +317,7 @@ class ProblemCache:
         await self._update(problems)
 
     async def _update(self, problems):
+        begin = time.time()
         self.logger.info(f'{len(problems)} problems fetched from API')
         contest_map = {problem.contestId: self.cache_master.contest_cache.contest_by_id.get(problem.contestId)
                        for problem in problems}
@@ -237,8 +337,11 @@ class ProblemCache:
         self.problem_by_name = problem_by_name
         self.problems_last_cache = time.time()
 
-        rc = self.cache_master.conn.cache_problems(self.problems)
+        rc = await self.cache_master.conn.aio.cache_problems(self.problems)
         self.logger.info(f'{rc} problems stored in database')
+        fingerprint = self.cache_master.conn.get_fingerprint('problem')
+        self.cache_master.save_snapshot('problems', fingerprint, self.problems)
+        self.stats.record_refresh(begin, rc)
 
 
 class ProblemsetCacheError(CacheError):
@@ -260,40 +363,61 @@ class ProblemsetCache:
         self.problem_to_contests = defaultdict(list)
         self.cache_master = cache_master
         self.update_lock = asyncio.Lock()
+        self.ready = asyncio.Event()
+        self.stats = CacheStats()
         self.logger = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
-        if self.cache_master.conn.problemset_empty():
-            self.logger.warning('Problemset cache on disk is empty. This must be populated '
-                                'manually before use.')
+        """Builds the problem index from disk. Requires the contest cache to be loaded."""
+        try:
+            if self.cache_master.conn.problemset_empty():
+                self.logger.warning('Problemset cache on disk is empty. This must be populated '
+                                    'manually before use.')
+            else:
+                async with self.stats.locked(self.update_lock):
+                    begin = time.time()
+                    await self._update_from_disk()
+                    self.stats.record_refresh(begin, len(self.problems))
+                self.logger.info(f'{len(self.problems)} problemset problems loaded from disk')
+        finally:
+            self.ready.set()
         self._update_task.start()
 
     async def update_for_contest(self, contest_id):
         """Update problemset for a particular contest. Intended for manual trigger."""
-        async with self.update_lock:
+        async with self.stats.locked(self.update_lock):
+            begin = time.time()
             contest = self.cache_master.contest_cache.get_contest(contest_id)
             problemset, _ = await self._fetch_problemsets([contest], force_fetch=True)
-            self.cache_master.conn.clear_problemset(contest_id)
-            self._save_problems(problemset)
+            await self.cache_master.conn.aio.clear_problemset(contest_id)
+            rc = await self._save_problems(problemset)
+            self.stats.record_refresh(begin, rc)
             return len(problemset)
 
     async def update_for_all(self):
         """Update problemsets for all finished contests. Intended for manual trigger."""
-        async with self.update_lock:
+        async with self.stats.locked(self.update_lock):
+            begin = time.time()
             contests = self.cache_master.contest_cache.contests_by_phase['FINISHED']
             problemsets, _ = await self._fetch_problemsets(contests, force_fetch=True)
-            self.cache_master.conn.clear_problemset()
-            self._save_problems(problemsets)
+            await self.cache_master.conn.aio.clear_problemset()
+            rc = await self._save_problems(problemsets)
+            self.stats.record_refresh(begin, rc)
             return len(problemsets)
 
+    def memory_estimate(self):
+        return _approx_size((self.problems, self.problem_to_contests))
+
     @tasks.task_spec(name='ProblemsetCacheUpdate',
                      waiter=tasks.Waiter.fixed_delay(_RELOAD_DELAY))
     async def _update_task(self, _):
-        async with self.update_lock:
+        async with self.stats.locked(self.update_lock):
+            begin = time.time()
             contests = self.cache_master.contest_cache.contests_by_phase['FINISHED']
             new_problems, updated_problems = await self._fetch_problemsets(contests)
-            self._save_problems(new_problems + updated_problems)
-            self._update_from_disk()
+            rc = await self._save_problems(new_problems + updated_problems)
+            await self._update_from_disk()
+            self.stats.record_refresh(begin, rc)
             self.logger.info(f'{len(new_problems)} new problems saved and {len(updated_problems)} '
                              'saved problems updated.')
 
@@ -336,71 +460,275 @@ class ProblemsetCache:
             problemset = []
         return problemset
 
-    def _save_problems(self, problems):
-        rc = self.cache_master.conn.cache_problemset(problems)
+    async def _save_problems(self, problems):
+        rc = await self.cache_master.conn.aio.cache_problemset(problems)
         self.logger.info(f'Saved {rc} problems to database.')
+        return rc
 
     def get_problemset(self, contest_id):
         problemset = self.cache_master.conn.fetch_problemset(contest_id)
+        self.stats.record_lookup(hit=bool(problemset))
         if not problemset:
             raise ProblemsetNotCached(contest_id)
         return problemset
 
-    def _update_from_disk(self):
-        self.problems = self.cache_master.conn.fetch_problems2()
-        self.problem_to_contests = defaultdict(list)
-        for problem in self.problems:
+    async def _update_from_disk(self):
+        # problem_to_contests also depends on which contests are known.
+        fingerprint = (self.cache_master.conn.get_fingerprint('problem2'),
+                       len(self.cache_master.contest_cache.contest_by_id))
+        snapshot = self.cache_master.load_snapshot('problemset', fingerprint)
+        if snapshot is not None:
+            self.problems, self.problem_to_contests = snapshot
+            return
+
+        problems = await self.cache_master.conn.aio.fetch_problems2()
+        problem_to_contests = defaultdict(list)
+        for problem in problems:
             try:
                 contest = cf_common.cache2.contest_cache.get_contest(problem.contestId)
                 problem_id = (problem.name, contest.startTimeSeconds)
-                self.problem_to_contests[problem_id].append(contest.id)
+                problem_to_contests[problem_id].append(contest.id)
             except ContestNotFound:
                 pass
+        self.problems = problems
+        self.problem_to_contests = problem_to_contests
+        self.cache_master.save_snapshot('problemset', fingerprint,
+                                        (problems, problem_to_contests))
 
 
 class RatingChangesCache:
     _RATED_DELAY = 36 * 60 * 60
     _RELOAD_DELAY = 10 * 60
+    _BACKFILL_CONCURRENCY = 3
+    # Rating histories are served from the database only if it misses at most this many
+    # contests, which are then fetched first.
+    _MAX_TOP_UP_CONTESTS = 10
+    # If more are missing, they are backfilled in the background, at most this often.
+    _AUTO_BACKFILL_DELAY = 60 * 60
+    # The old rating of the first contest of an account, 1500 before the rating system change
+    # of 2020 and 0 after.
+    _INITIAL_RATINGS = (0, 1500)
 
     def __init__(self, cache_master):
         self.cache_master = cache_master
         self.monitored_contests = []
         self.handle_rating_cache = {}
+        self._sorted_ratings = None
+        self.backfill_lock = asyncio.Lock()
+        self.top_up_lock = asyncio.Lock()
+        self.top_up_time_by_contest = {}
+        self.auto_backfill_task = None
+        self.auto_backfill_time = None
+        self.ready = asyncio.Event()
+        self.stats = CacheStats()
         self.logger = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
-        self._refresh_handle_cache()
-        if not self.handle_rating_cache:
-            self.logger.warning('Rating changes cache on disk is empty. This must be populated '
-                                'manually before use.')
+        # Start waiting for ContestListRefresh before the contest cache first dispatches it.
         self._update_task.start()
+        try:
+            begin = time.time()
+            await self._refresh_handle_cache()
+            self.stats.record_refresh(begin, len(self.handle_rating_cache))
+        finally:
+            self.ready.set()
+        if not self.handle_rating_cache:
+            self.logger.warning('Rating changes cache on disk is empty, it is populated in the '
+                                'background.')
+        # Databases from before rating_change_fetched count every unrated contest as missing,
+        # and until they are fetched rating histories come from the API.
+        await self.cache_master.contest_cache.ready.wait()
+        missing = await self._get_missing_contests()
+        if len(missing) > self._MAX_TOP_UP_CONTESTS:
+            self._start_auto_backfill(len(missing))
 
     async def fetch_contest(self, contest_id):
         """Fetch rating changes for a particular contest. Intended for manual trigger."""
         contest = self.cache_master.contest_cache.contest_by_id[contest_id]
         changes = await self._fetch([contest])
-        self.cache_master.conn.clear_rating_changes(contest_id=contest_id)
-        self._save_changes(changes)
+        await self.cache_master.conn.aio.clear_rating_changes(contest_id=contest_id)
+        await self._save_changes(changes)
         return len(changes)
 
-    async def fetch_all_contests(self):
+    async def fetch_all_contests(self, progress=None):
         """Fetch rating changes for all contests. Intended for manual trigger."""
-        self.cache_master.conn.clear_rating_changes()
-        return await self.fetch_missing_contests()
+        async with self.stats.locked(self.backfill_lock):
+            # Under the lock, so that a backfill in progress does not checkpoint contests whose
+            # changes were just cleared.
+            await self.cache_master.conn.aio.clear_rating_changes()
+            return await self._backfill(progress)
 
-    async def fetch_missing_contests(self):
+    async def fetch_missing_contests(self, progress=None):
         """Fetch rating changes for contests which are not saved in database. Intended for
-        manual trigger."""
-        contests = self.cache_master.contest_cache.contests_by_phase['FINISHED']
-        contests = [
-            contest for contest in contests if not self.has_rating_changes_saved(contest.id)]
-        total_changes = 0
+        manual trigger.
+
+        Contests are fetched concurrently in batches and every batch is saved together with a
+        checkpoint, so an interrupted run picks up where it stopped. `progress`, if given, is a
+        coroutine function called after every batch with the number of contests done, the total
+        number of contests and the number of changes saved so far.
+        """
+        async with self.stats.locked(self.backfill_lock):
+            return await self._backfill(progress)
+
+    async def _backfill(self, progress):
+        """Does the work of `fetch_missing_contests`. Must be called with `backfill_lock`
+        held."""
+        begin = time.time()
+        contests = await self._get_missing_contests()
+        self.logger.info(f'Backfilling rating changes for {len(contests)} contests')
+
+        semaphore = asyncio.Semaphore(self._BACKFILL_CONCURRENCY)
+
+        async def fetch_one(contest):
+            async with semaphore:
+                return contest, await self._fetch_one(contest)
+
+        done = total_changes = 0
         for contests_chunk in paginator.chunkify(contests, _CONTESTS_PER_BATCH_IN_CACHE_UPDATES):
-            contests_chunk = await self._fetch(contests_chunk)
-            self._save_changes(contests_chunk)
-            total_changes += len(contests_chunk)
+            results = await asyncio.gather(*map(fetch_one, contests_chunk))
+            done += len(contests_chunk)
+            total_changes += await self._save_batch(results)
+            self.logger.info(f'{done}/{len(contests)} contests done.')
+            if progress is not None:
+                # A failed progress report, like an edit of a deleted message, must not stop
+                # the backfill.
+                try:
+                    await progress(done, len(contests), total_changes)
+                except Exception as e:
+                    self.logger.warning(f'Backfill progress report failed, continuing. {e!r}')
+
+        if total_changes:
+            await self._refresh_handle_cache()
+        self.stats.record_refresh(begin, total_changes)
         return total_changes
 
+    async def _save_batch(self, results):
+        """Save the (contest, changes) pairs of a batch of fetches together with their
+        checkpoints, and return the number of changes."""
+        now = time.time()
+        changes = [change for _, contest_changes in results if contest_changes
+                   for change in contest_changes]
+        # Failed fetches are retried on the next run. An empty list may only mean that rating
+        # changes are not out yet, so it is final only after _RATED_DELAY.
+        fetched = [(contest.id, len(contest_changes))
+                   for contest, contest_changes in results
+                   if contest_changes is not None and
+                   (contest_changes or now - contest.end_time >= self._RATED_DELAY)]
+        rc = await self.cache_master.conn.aio.save_rating_changes_batch(changes, fetched,
+                                                                        int(now))
+        self.logger.info(f'Saved {rc} changes to database.')
+        return len(changes)
+
+    async def get_rating_history(self, handle):
+        """Returns the rating changes of `handle` in chronological order, like `cf.user.rating`.
+
+        The history is read from the database if it is complete, after fetching the few contests
+        it may be missing. Otherwise, or if the saved changes of the handle do not make up its
+        whole history, as for handles renamed since some of their contests, it comes from the API.
+        """
+        if not self.backfill_lock.locked() and await self._top_up():
+            changes = await self.cache_master.conn.aio.get_rating_changes_for_handle(handle)
+            if changes and self._is_full_history(handle, changes):
+                self.stats.record_lookup()
+                return changes
+        self.stats.record_lookup(hit=False)
+        return await cf.user.rating(handle=handle)
+
+    def _is_full_history(self, handle, changes):
+        """Whether `changes` starts at the first contest of the account and has no gaps.
+
+        Contests rated under an earlier name of the handle are saved under that name. Without
+        them the history starts from a rating the account did not begin with, or misses the
+        peak recorded in the cached profile of the handle.
+        """
+        if changes[0].oldRating not in self._INITIAL_RATINGS:
+            return False
+        if any(prev.newRating != cur.oldRating for prev, cur in zip(changes, changes[1:])):
+            return False
+        try:
+            user = cf_common.user_db.fetch_cf_user(handle)
+        except db.DatabaseDisabledError:
+            user = None
+        if user is not None and user.maxRating is not None:
+            return user.maxRating <= max(change.newRating for change in changes)
+        return True
+
+    async def _get_missing_contests(self):
+        contest_by_id = self.cache_master.contest_cache.contest_by_id
+        contest_ids = await self.cache_master.conn.aio.get_contests_without_rating_changes()
+        return [contest_by_id[contest_id] for contest_id in contest_ids
+                if contest_id in contest_by_id]
+
+    def _start_auto_backfill(self, num_missing):
+        """Fetch the missing contests in the background, unless a backfill is running or one
+        was started recently."""
+        now = time.time()
+        if (self.backfill_lock.locked() or self.auto_backfill_time is not None and
+                now - self.auto_backfill_time < self._AUTO_BACKFILL_DELAY):
+            return
+        self.auto_backfill_time = now
+        self.logger.warning(f'Rating changes of {num_missing} contests are missing, rating '
+                            'histories come from the API until they are fetched. Fetching them '
+                            'in the background.')
+        self.auto_backfill_task = asyncio.create_task(self.fetch_missing_contests())
+        self.auto_backfill_task.add_done_callback(self._on_auto_backfill_done)
+
+    def _on_auto_backfill_done(self, task):
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            self.logger.warning(f'Background backfill of rating changes failed. {error!r}')
+        else:
+            self.logger.info(f'Background backfill saved {task.result()} rating changes')
+
+    async def _top_up(self):
+        """Fetch the contests missing from the database if there are only a few of them. Returns
+        whether the database is then complete."""
+        async with self.top_up_lock:
+            missing = await self._get_missing_contests()
+            if len(missing) > self._MAX_TOP_UP_CONTESTS:
+                self._start_auto_backfill(len(missing))
+                return False
+            # Rating changes of recently finished contests may not be out yet, do not ask for
+            # them on every call.
+            now = time.time()
+            to_fetch = [contest for contest in missing
+                        if now - self.top_up_time_by_contest.get(contest.id, 0) >=
+                        self._RELOAD_DELAY]
+            if not to_fetch:
+                return True
+            for contest in to_fetch:
+                self.top_up_time_by_contest[contest.id] = now
+            results = [(contest, await self._fetch_one(contest)) for contest in to_fetch]
+            if await self._save_batch(results):
+                await self._refresh_handle_cache()
+            # Once saved here, the monitor task drops these contests, so announce their
+            # changes as it would have.
+            monitored_ids = {contest.id for contest in self.monitored_contests}
+            for contest, changes in results:
+                if changes and contest.id in monitored_ids:
+                    cf_common.event_sys.dispatch(events.RatingChangesUpdate, contest=contest,
+                                                 rating_changes=changes)
+            failed = [contest for contest, changes in results if changes is None]
+            for contest in failed:
+                # Try again on the next call.
+                del self.top_up_time_by_contest[contest.id]
+            return not failed
+
+    async def replay_ratings(self, handles=None, **kwargs):
+        """Replay every saved contest in order and return the `RatingReplay`. `handles` limits
+        the replay to those handles, other keyword arguments go to `RatingReplay`."""
+        begin = time.time()
+        replay = RatingReplay(handles=handles, **kwargs)
+        conn = self.cache_master.conn
+        # One contest at a time on the database thread, the loop runs other tasks in between.
+        for contest_id in await conn.aio.get_rated_contest_ids():
+            replay.replay_contest(await conn.aio.get_rating_change_rows_for_contest(contest_id))
+        self.logger.info(f'Replayed {replay.contests_replayed} contests in '
+                         f'{time.time() - begin:.2f} seconds')
+        return replay
+
     def is_newly_finished_without_rating_changes(self, contest):
         now = time.time()
         return (contest.phase == 'FINISHED' and
@@ -437,58 +765,79 @@ class RatingChangesCache:
     @tasks.task_spec(name='RatingChangesCacheUpdate.MonitorNewlyFinishedContests',
                      waiter=tasks.Waiter.fixed_delay(_RELOAD_DELAY))
     async def _monitor_task(self, _):
-        self.monitored_contests = [
-            contest for contest in self.monitored_contests
-            if self.is_newly_finished_without_rating_changes(contest)
-            and not _is_blacklisted(contest)
-        ]
+        # Shared with _top_up, so that the changes of a contest are saved and announced by only
+        # one of the two.
+        async with self.top_up_lock:
+            self.monitored_contests = [
+                contest for contest in self.monitored_contests
+                if self.is_newly_finished_without_rating_changes(contest)
+                and not _is_blacklisted(contest)
+            ]
+            contest_changes_pairs = []
+            if self.monitored_contests:
+                contest_changes_pairs = await self._fetch(self.monitored_contests)
+                # Sort by the rating update time of the first change in the list of changes,
+                # assuming every change in the list has the same time.
+                contest_changes_pairs.sort(key=lambda pair: pair[1][0].ratingUpdateTimeSeconds)
+                await self._save_changes(contest_changes_pairs)
 
         if not self.monitored_contests:
             self.logger.info('Rated changes fetched for contests that were being monitored.')
             await self._monitor_task.stop()
             return
 
-        contest_changes_pairs = await self._fetch(self.monitored_contests)
-        # Sort by the rating update time of the first change in the list of changes, assuming
-        # every change in the list has the same time.
-        contest_changes_pairs.sort(key=lambda pair: pair[1][0].ratingUpdateTimeSeconds)
-        self._save_changes(contest_changes_pairs)
         for contest, changes in contest_changes_pairs:
             cf_common.event_sys.dispatch(events.RatingChangesUpdate, contest=contest,
                                          rating_changes=changes)
 
+    async def _fetch_one(self, contest):
+        """Returns the list of rating changes for the contest, or None if the fetch failed."""
+        try:
+            changes = await cf.contest.ratingChanges(contest_id=contest.id)
+        except cf.RatingChangesUnavailableError:
+            changes = []
+        except cf.CodeforcesApiError as er:
+            self.logger.warning(f'Fetch rating changes failed for contest {contest.id}, ignoring. {er!r}')
+            return None
+        self.logger.info(f'{len(changes)} rating changes fetched for contest {contest.id}')
+        return changes
+
     async def _fetch(self, contests):
         all_changes = []
         for contest in contests:
-            try:
-                changes = await cf.contest.ratingChanges(contest_id=contest.id)
-                self.logger.info(f'{len(changes)} rating changes fetched for contest {contest.id}')
-                if changes:
-                    all_changes.append((contest, changes))
-            except cf.CodeforcesApiError as er:
-                self.logger.warning(f'Fetch rating changes failed for contest {contest.id}, ignoring. {er!r}')
-                pass
+            changes = await self._fetch_one(contest)
+            if changes:
+                all_changes.append((contest, changes))
         return all_changes
 
-    def _save_changes(self, contest_changes_pairs):
+    async def _save_changes(self, contest_changes_pairs):
+        begin = time.time()
         flattened = [change for _, changes in contest_changes_pairs for change in changes]
         if not flattened:
             return
-        rc = self.cache_master.conn.save_rating_changes(flattened)
+        rc = await self.cache_master.conn.aio.save_rating_changes(flattened)
         self.logger.info(f'Saved {rc} changes to database.')
-        self._refresh_handle_cache()
-
-    def _refresh_handle_cache(self):
-        changes = self.cache_master.conn.get_all_rating_changes()
-        handle_rating_cache = {}
-        for change in changes:
-            handle_rating_cache[change.handle] = change.newRating
+        await self._refresh_handle_cache()
+        self.stats.record_refresh(begin, rc)
+
+    async def _refresh_handle_cache(self):
+        fingerprint = self.cache_master.conn.get_fingerprint('rating_change')
+        handle_rating_cache = self.cache_master.load_snapshot('handle_ratings', fingerprint)
+        if handle_rating_cache is None:
+            handle_rating_cache = await self.cache_master.conn.aio.get_latest_ratings()
+            if handle_rating_cache:
+                self.cache_master.save_snapshot('handle_ratings', fingerprint, handle_rating_cache)
         self.handle_rating_cache = handle_rating_cache
+        self._sorted_ratings = None
         self.logger.info(f'Ratings for {len(handle_rating_cache)} handles cached')
 
     def get_users_with_more_than_n_contests(self, time_cutoff, n):
         return self.cache_master.conn.get_users_with_more_than_n_contests(time_cutoff, n)
 
+    async def get_ratings_of_users_with_more_than_n_contests(self, time_cutoff, n):
+        return await self.cache_master.conn.aio.get_ratings_of_users_with_more_than_n_contests(
+            time_cutoff, n)
+
     def get_rating_changes_for_contest(self, contest_id):
         return self.cache_master.conn.get_rating_changes_for_contest(contest_id)
 
@@ -499,12 +848,25 @@ class RatingChangesCache:
         return self.cache_master.conn.get_rating_changes_for_handle(handle)
 
     def get_current_rating(self, handle, default_if_absent=False):
-        return self.handle_rating_cache.get(handle,
-                                            cf.DEFAULT_RATING if default_if_absent else None)
+        rating = self.handle_rating_cache.get(handle)
+        self.stats.record_lookup(hit=rating is not None)
+        if rating is None and default_if_absent:
+            return cf.DEFAULT_RATING
+        return rating
+
+    def memory_estimate(self):
+        return _approx_size(self.handle_rating_cache)
 
     def get_all_ratings(self):
         return list(self.handle_rating_cache.values())
 
+    def get_sorted_ratings(self):
+        """Returns the ratings of all handles in ascending order. The list is shared until the
+        ratings next change, do not modify it."""
+        if self._sorted_ratings is None:
+            self._sorted_ratings = sorted(self.handle_rating_cache.values())
+        return self._sorted_ratings
+
 
 class RanklistCacheError(CacheError):
     pass
@@ -515,23 +877,84 @@ class RanklistNotMonitored(RanklistCacheError):
         super().__init__(f'The ranklist for `{contest.name}` is not being monitored')
         self.contest = contest
 
+def _count_changed_rows(ranklist, previous):
+    if previous is None:
+        return len(ranklist.standings)
+    changed = 0
+    for id_, row in ranklist.standing_by_id.items():
+        try:
+            changed += previous.standing_by_id[id_] != row
+        except KeyError:
+            changed += 1
+    return changed
+
+
 class RanklistCache:
     _RELOAD_DELAY = 2 * 60
+    # Standings barely change while waiting for system tests or rating changes, so such
+    # contests are refreshed less often.
+    _RELOAD_DELAY_BY_PHASE = {
+        'CODING': _RELOAD_DELAY,
+        'PENDING_SYSTEM_TEST': 5 * 60,
+        'SYSTEM_TEST': _RELOAD_DELAY,
+        'FINISHED': 5 * 60,
+    }
+
+    _SNAPSHOT_PREFIX = 'ranklist_'
+    # Ranklists restored from disk are refreshed spread over this many seconds, so that a
+    # restart does not hit the API for every contest at once.
+    _RESTORE_REFRESH_SPREAD = 60
 
     def __init__(self, cache_master):
         self.cache_master = cache_master
         self.monitored_contests = []
         self.ranklist_by_contest = {}
+        # Every monitored contest is refreshed by its own task, so that a slow contest does not
+        # hold up the others.
+        self.monitor_task_by_contest = {}
+        # Snapshot saves still running on their thread, which cancelling a monitor task does
+        # not stop.
+        self.snapshot_save_by_contest = {}
+        self.ready = asyncio.Event()
+        self.stats = CacheStats()
         self.logger = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
+        try:
+            await self._restore_ranklists()
+        finally:
+            self.ready.set()
         self._update_task.start()
 
+    async def _restore_ranklists(self):
+        """Load the ranklists saved by the previous run. They are served until their contests
+        are refreshed, or dropped once the contests turn out to be no longer monitored."""
+        for name in self.cache_master.list_snapshots(self._SNAPSHOT_PREFIX):
+            try:
+                contest_id = int(name[len(self._SNAPSHOT_PREFIX):])
+            except ValueError:
+                continue
+            # Ranklists of big rounds take several MB, read and unpickle them off the loop.
+            ranklist = await asyncio.to_thread(self.cache_master.load_snapshot, name, contest_id)
+            if ranklist is not None:
+                self.ranklist_by_contest[contest_id] = ranklist
+        if self.ranklist_by_contest:
+            self.logger.info(f'Restored ranklists for {len(self.ranklist_by_contest)} contests')
+
+    def _snapshot_name(self, contest_id):
+        return f'{self._SNAPSHOT_PREFIX}{contest_id}'
+
     def get_ranklist(self, contest):
         try:
-            return self.ranklist_by_contest[contest.id]
+            ranklist = self.ranklist_by_contest[contest.id]
         except KeyError:
+            self.stats.record_lookup(hit=False)
             raise RanklistNotMonitored(contest)
+        self.stats.record_lookup()
+        return ranklist
+
+    def memory_estimate(self):
+        return _approx_size(self.ranklist_by_contest)
 
     @tasks.task_spec(name='RanklistCacheUpdate',
                      waiter=tasks.Waiter.for_event(events.ContestListRefresh))
@@ -542,44 +965,109 @@ class RanklistCache:
         rating_cache = self.cache_master.rating_changes_cache
         finished_contests = [
             contest for contest in contests_by_phase['FINISHED']
-            if not _is_blacklisted(contest)
-            and rating_cache.is_newly_finished_without_rating_changes(contest)
+            if rating_cache.is_newly_finished_without_rating_changes(contest)
         ]
 
-        to_monitor = running_contests + finished_contests
-        cur_ids = {contest.id for contest in self.monitored_contests}
+        to_monitor = [contest for contest in running_contests + finished_contests
+                      if not _is_blacklisted(contest)]
         new_ids = {contest.id for contest in to_monitor}
-        if new_ids != cur_ids:
-            await self._monitor_task.stop()
-            if to_monitor:
-                self.monitored_contests = to_monitor
-                self._monitor_task.start()
+        for contest_id in set(self.monitor_task_by_contest) | set(self.ranklist_by_contest):
+            if contest_id not in new_ids:
+                await self._stop_monitoring(contest_id)
+        for contest in to_monitor:
+            if contest.id not in self.monitor_task_by_contest:
+                self._start_monitoring(contest.id)
+        self.monitored_contests = to_monitor
+
+    def _start_monitoring(self, contest_id):
+        first_delay = 0
+        restored = self.ranklist_by_contest.get(contest_id)
+        if restored is not None:
+            # Refresh a restored ranklist when it would have been refreshed anyway.
+            age = time.time() - restored.fetch_time
+            first_delay = (max(0, self._reload_delay(contest_id) - age) +
+                           random.uniform(0, self._RESTORE_REFRESH_SPREAD))
+
+        async def monitor(_):
+            await self._refresh_contest(contest_id)
+
+        async def wait():
+            nonlocal first_delay
+            if first_delay is not None:
+                delay, first_delay = first_delay, None
             else:
-                self.ranklist_by_contest = {}
-
-    @tasks.task_spec(name='RanklistCacheUpdate.MonitorActiveContests',
-                     waiter=tasks.Waiter.fixed_delay(_RELOAD_DELAY))
-    async def _monitor_task(self, _):
+                delay = self._reload_delay(contest_id)
+            await asyncio.sleep(delay)
+            return delay
+
+        task = tasks.Task(f'RanklistCacheUpdate.MonitorContest.{contest_id}', monitor,
+                          tasks.Waiter(wait, run_first=True))
+        self.monitor_task_by_contest[contest_id] = task
+        task.start()
+
+    async def _stop_monitoring(self, contest_id):
+        self.ranklist_by_contest.pop(contest_id, None)
+        task = self.monitor_task_by_contest.pop(contest_id, None)
+        # A save in progress would write the snapshot again after it is deleted. No new save
+        # starts once the contest has left monitor_task_by_contest.
+        save = self.snapshot_save_by_contest.get(contest_id)
+        if save is not None:
+            await asyncio.wait([save])
+        self.cache_master.delete_snapshot(self._snapshot_name(contest_id))
+        if task is not None:
+            await task.stop()
+
+    def _reload_delay(self, contest_id):
+        contest = self.cache_master.contest_cache.contest_by_id.get(contest_id)
+        phase = contest.phase if contest is not None else None
+        return self._RELOAD_DELAY_BY_PHASE.get(phase, self._RELOAD_DELAY)
+
+    async def _refresh_contest(self, contest_id):
+        # Use the latest known state of the contest, the phase may have changed since monitoring
+        # started.
+        contest = self.cache_master.contest_cache.contest_by_id.get(contest_id)
         cache = self.cache_master.rating_changes_cache
-        self.monitored_contests = [
-            contest for contest in self.monitored_contests
-            if not _is_blacklisted(contest) and (
-                contest.phase != 'FINISHED'
-                or cache.is_newly_finished_without_rating_changes(contest))
-        ]
-
-        if not self.monitored_contests:
-            self.ranklist_by_contest = {}
-            self.logger.info('No more active contests for which to monitor ranklists.')
-            await self._monitor_task.stop()
+        if contest is None or (contest.phase == 'FINISHED' and
+                               not cache.is_newly_finished_without_rating_changes(contest)):
+            self.logger.info(f'No longer monitoring ranklist for contest {contest_id}.')
+            self.monitored_contests = [contest for contest in self.monitored_contests
+                                       if contest.id != contest_id]
+            await self._stop_monitoring(contest_id)
             return
 
-        ranklist_by_contest = await self._fetch(self.monitored_contests)
-        # If any ranklist could not be fetched, the old ranklist is kept.
-        for contest_id, ranklist in ranklist_by_contest.items():
+        begin = time.time()
+        previous = self.ranklist_by_contest.get(contest_id)
+        try:
+            ranklist = await self.generate_ranklist(contest_id, predict_changes=True,
+                                                    previous=previous)
+        except cf.CodeforcesApiError as er:
+            # If the ranklist could not be fetched, the old ranklist is kept.
+            self.logger.warning(f'Ranklist fetch failed for contest {contest_id}. {er!r}')
+            return
+        if contest_id in self.monitor_task_by_contest:
             self.ranklist_by_contest[contest_id] = ranklist
-
-    async def generate_ranklist(self, contest_id, *, fetch_changes=False, predict_changes=False):
+            # Ranklists are not modified once built, so they can be pickled on another thread.
+            save = asyncio.ensure_future(asyncio.to_thread(
+                self.cache_master.save_snapshot, self._snapshot_name(contest_id), contest_id,
+                ranklist))
+            self.snapshot_save_by_contest[contest_id] = save
+
+            def forget_save(_):
+                if self.snapshot_save_by_contest.get(contest_id) is save:
+                    del self.snapshot_save_by_contest[contest_id]
+
+            save.add_done_callback(forget_save)
+            # Cancelling the monitor task leaves the save running, _stop_monitoring waits for it.
+            await asyncio.shield(save)
+            self.stats.record_refresh(begin, _count_changed_rows(ranklist, previous))
+            self.logger.info(f'Ranklist fetched for contest {contest_id}')
+
+    async def generate_ranklist(self, contest_id, *, fetch_changes=False, predict_changes=False,
+                                previous=None):
+        """Fetch the standings of a contest and build its ranklist. With `predict_changes`, the
+        ranklist `previous` from an earlier refresh, if given, lets prediction be skipped when
+        no rated row has changed.
+        """
         assert fetch_changes ^ predict_changes
 
         contest, problems, standings = await cf.contest.standings(contest_id=contest_id,
@@ -607,7 +1095,10 @@ class RanklistCache:
         elif predict_changes:
             # Rating changes have not been applied yet, predict rating changes.
             # For running/recent contests.
-            _, _, standings_official = await cf.contest.standings(contest_id=contest_id)
+            # The official standings are the CONTESTANT rows of the unofficial ones, no need
+            # to fetch them separately.
+            standings_official = [row for row in standings
+                                  if row.party.participantType == 'CONTESTANT']
 
             has_teams = any(row.party.teamId is not None for row in standings_official)
             if cf_common.is_nonstandard_contest(contest) or has_teams:
@@ -623,7 +1114,11 @@ class RanklistCache:
                     current_rating = {handle: rating
                                       for handle, rating in current_rating.items() if rating < 2100}
                 ranklist = Ranklist(contest, problems, standings, now, is_rated=True)
-                ranklist.predict(current_rating)
+                await ranklist.predict(current_rating, previous=previous,
+                                       service=self.cache_master.prediction_service)
+                if previous is not None and ranklist.delta_by_handle is previous.delta_by_handle:
+                    self.logger.info(f'Rated rows unchanged for contest {contest_id}, '
+                                     'reusing predicted deltas')
 
         return ranklist
 
@@ -649,44 +1144,85 @@ class RanklistCache:
         current_vc_rating = {handle: cf_common.user_db.get_vc_rating(handle_to_member_id.get(handle))
                                 for handle in handles}
         ranklist = Ranklist(contest, problems, standings, now, is_rated=True)
-        delta_by_handle = {}
-        for handle in handles:
-            mixed_ratings = current_official_rating.copy()
-            mixed_ratings[handle] = current_vc_rating.get(handle)
-            ranklist.predict(mixed_ratings)
-            delta_by_handle[handle] = ranklist.delta_by_handle.get(handle, 0)
-
-        ranklist.delta_by_handle = delta_by_handle
+        await ranklist.predict_virtual(current_official_rating, current_vc_rating,
+                                       service=self.cache_master.prediction_service)
+        ranklist.delta_by_handle = {handle: ranklist.delta_by_handle.get(handle, 0)
+                                    for handle in handles}
         return ranklist
 
-    async def _fetch(self, contests):
-        ranklist_by_contest = {}
-        for contest in contests:
-            try:
-                ranklist = await self.generate_ranklist(contest.id, predict_changes=True)
-                ranklist_by_contest[contest.id] = ranklist
-                self.logger.info(f'Ranklist fetched for contest {contest.id}')
-            except cf.CodeforcesApiError as er:
-                self.logger.warning(f'Ranklist fetch failed for contest {contest.id}. {er!r}')
-
-        return ranklist_by_contest
-
 
 class CacheSystem:
-    def __init__(self, conn):
+    def __init__(self, conn, snapshot=None):
         self.conn = conn
+        self.snapshot = snapshot
+        # Rating predictions for ranklists run here, off the event loop.
+        self.prediction_service = PredictionService()
         self.contest_cache = ContestCache(self)
         self.problem_cache = ProblemCache(self)
         self.rating_changes_cache = RatingChangesCache(self)
         self.ranklist_cache = RanklistCache(self)
         self.problemset_cache = ProblemsetCache(self)
+        # The exception that stopped `run`, if any.
+        self.startup_error = None
+
+    @property
+    def caches(self):
+        return (self.contest_cache, self.problem_cache, self.rating_changes_cache,
+                self.ranklist_cache, self.problemset_cache)
 
     async def run(self):
-        await self.rating_changes_cache.run()
-        await self.ranklist_cache.run()
+        """Loads all caches from disk and starts their update tasks. Caches which do not depend
+        on each other are loaded concurrently, and every cache sets its `ready` event as soon as
+        its own data is available.
+        """
+        begin = time.time()
+        await asyncio.gather(self.rating_changes_cache.run(),
+                             self.ranklist_cache.run(),
+                             self._run_contest_dependents())
+        logger.info(f'All caches loaded in {time.time() - begin:.2f} seconds')
+
+    async def _run_contest_dependents(self):
+        # Yield once so that the tasks waiting for ContestListRefresh are subscribed before the
+        # contest cache dispatches it.
+        await asyncio.sleep(0)
         await self.contest_cache.run()
-        await self.problem_cache.run()
-        await self.problemset_cache.run()
+        await asyncio.gather(self.problem_cache.run(), self.problemset_cache.run())
+
+    def fail_startup(self, error):
+        """Records that `run` failed and releases everything waiting for the caches, which
+        then get an error instead of waiting forever."""
+        self.startup_error = error
+        for cache in self.caches:
+            cache.ready.set()
+
+    async def wait_until_ready(self, *caches):
+        """Waits until the given caches, or all caches if none are given, are loaded. Raises
+        `CacheError` if loading the caches failed."""
+        for cache in caches or self.caches:
+            await cache.ready.wait()
+        if self.startup_error is not None:
+            raise CacheError('The caches failed to load, please contact an admin.')
+
+    def load_snapshot(self, name, fingerprint):
+        """Returns the snapshot saved under `name` if it matches `fingerprint`, else None."""
+        if self.snapshot is None:
+            return None
+        begin = time.time()
+        data = self.snapshot.load(name, fingerprint)
+        if data is not None:
+            logger.info(f'Snapshot `{name}` loaded in {time.time() - begin:.2f} seconds')
+        return data
+
+    def save_snapshot(self, name, fingerprint, data):
+        if self.snapshot is not None:
+            self.snapshot.save(name, fingerprint, data)
+
+    def delete_snapshot(self, name):
+        if self.snapshot is not None:
+            self.snapshot.delete(name)
+
+    def list_snapshots(self, prefix=''):
+        return self.snapshot.names(prefix) if self.snapshot is not None else []
 
     @staticmethod
     @cached(ttl=30 * 60)
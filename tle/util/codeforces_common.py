@@ -1,3 +1,4 @@
+import asyncio
 import functools
 import json
 import logging
@@ -12,9 +13,11 @@ import discord
 
 from tle import constants
 from tle.util import cache_system2
+from tle.util import cache_snapshot
 from tle.util import codeforces_api as cf
 from tle.util import clist_api as clist
 from tle.util import db
+from tle.util.db import backup
 from tle.util import events
 
 logger = logging.getLogger(__name__)
@@ -32,10 +35,18 @@ _contest_id_to_writers_map = None
 
 _initialize_done = False
 
+_cache_startup_task = None
+
 active_groups = defaultdict(set)
 
 default_timezone = pytz.timezone('Asia/Kolkata')
 
+# Handles or account ids of the members of a role, by (guild id, role id, resource). Kept for a
+# short while, since the same role tends to be used in several commands in a row.
+_ROLE_CACHE_TTL = 30
+_ROLE_CACHE_MAX_SIZE = 256
+_role_cache = {}
+
 
 async def initialize(nodb):
     global cache2
@@ -43,6 +54,7 @@ async def initialize(nodb):
     global event_sys
     global _contest_id_to_writers_map
     global _initialize_done
+    global _cache_startup_task
 
     if _initialize_done:
         # This happens if the bot loses connection to Discord and on_ready is triggered again
@@ -55,10 +67,18 @@ async def initialize(nodb):
         user_db = db.DummyUserDbConn()
     else:
         user_db = db.UserDbConn(constants.USER_DB_FILE_PATH)
+        backend = backup.backend_from_env()
+        if backend is not None:
+            user_db.backup = backup.BackupManager(user_db, backend)
+            user_db.backup.start()
 
     cache_db = db.CacheDbConn(constants.CACHE_DB_FILE_PATH)
-    cache2 = cache_system2.CacheSystem(cache_db)
-    await cache2.run()
+    snapshot = cache_snapshot.CacheSnapshot(constants.CACHE_SNAPSHOT_DIR)
+    cache2 = cache_system2.CacheSystem(cache_db, snapshot)
+    # Load the caches in the background so that the bot can connect right away. Commands wait
+    # for the caches they need through `cache_ready`.
+    _cache_startup_task = asyncio.create_task(cache2.run())
+    _cache_startup_task.add_done_callback(_on_cache_startup_done)
 
     try:
         with open(constants.CONTEST_WRITERS_JSON_FILE_PATH) as f:
@@ -71,6 +91,27 @@ async def initialize(nodb):
     _initialize_done = True
 
 
+def close():
+    """Writes out what is still pending in the user database and backs it up. For use on
+    shutdown."""
+    if user_db is not None and not isinstance(user_db, db.DummyUserDbConn):
+        user_db.close()
+
+
+def _on_cache_startup_done(task):
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        logger.error('Loading the caches failed', exc_info=error)
+        cache2.fail_startup(error)
+
+
+async def cache_ready(*names):
+    """Waits until the named caches of `cache2`, e.g. 'contest_cache', are loaded."""
+    await cache2.wait_until_ready(*(getattr(cache2, name) for name in names))
+
+
 # algmyr's guard idea:
 def user_guard(*, group, get_exception=None):
     active = active_groups[group]
@@ -228,6 +269,28 @@ def get_guild_timezone(guild_id):
         timezone = pytz.timezone(localtimezone)
     return timezone
 
+def _resolve_role(guild, role, resource):
+    """Returns the handles, or the account ids on `resource`, of the members of `role` who
+    registered one."""
+    key = (guild.id, role.id, resource)
+    now = time.monotonic()
+    cached = _role_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    user_ids = [member.id for member in role.members]
+    if resource=='codeforces.com':
+        values = user_db.get_handles(user_ids, guild.id)
+    else:
+        values = user_db.get_account_ids(user_ids, guild.id, resource)
+    values = [value for value in values if value is not None]
+    if len(_role_cache) >= _ROLE_CACHE_MAX_SIZE:
+        for expired_key in [k for k, (expiry, _) in _role_cache.items() if expiry <= now]:
+            del _role_cache[expired_key]
+        if len(_role_cache) >= _ROLE_CACHE_MAX_SIZE:
+            _role_cache.clear()
+    _role_cache[key] = (now + _ROLE_CACHE_TTL, values)
+    return values
+
 async def resolve_handles(ctx, converter, handles, *, mincnt=1, maxcnt=5, default_to_all_server=False, resource='codeforces.com'):
     """Convert an iterable of strings to CF handles. A string beginning with ! indicates Discord username,
      otherwise it is a raw CF handle to be left unchanged."""
@@ -256,16 +319,10 @@ async def resolve_handles(ctx, converter, handles, *, mincnt=1, maxcnt=5, defaul
                 role = await role_converter.convert(ctx, role_identifier)
             except commands.errors.CommandError:
                 raise FindRoleFailedError(role_identifier)
-            for member in ctx.guild.members:
-                if role in member.roles:
-                    if resource=='codeforces.com':
-                        handle = user_db.get_handle(member.id, ctx.guild.id)
-                        if handle is not None:
-                            resolved_handles.add(handle)
-                    else:
-                        account_id = user_db.get_account_id(member.id, ctx.guild.id, resource=resource)
-                        if account_id is not None:
-                            account_ids.add(account_id)
+            if resource=='codeforces.com':
+                resolved_handles.update(_resolve_role(ctx.guild, role, resource))
+            else:
+                account_ids.update(_resolve_role(ctx.guild, role, resource))
         elif handle.startswith('+'):
             list_name = handle[1:]
             if resource=='codeforces.com':
@@ -314,12 +371,10 @@ async def resolve_handles(ctx, converter, handles, *, mincnt=1, maxcnt=5, defaul
         return list(account_ids)
 
 def members_to_handles(members: [discord.Member], guild_id):
-    handles = []
-    for member in members:
-        handle = user_db.get_handle(member.id, guild_id)
+    handles = user_db.get_handles([member.id for member in members], guild_id)
+    for member, handle in zip(members, handles):
         if handle is None:
             raise HandleNotRegisteredError(member)
-        handles.append(handle)
     return handles
 
 def filter_flags(args, params):
@@ -0,0 +1,192 @@
+"""
+    Off-site backups of the user database.
+
+    Writes only mark the database as changed. A backup is made some time after the first change,
+    so that a burst of writes results in one backup. Each backup is a consistent copy made with
+    SQLite's online backup API, and it is uploaded only if it differs from the last upload.
+
+    On startup the backup is restored, unless the local database is at least as recent, e.g.
+    because writes made after the last upload were never uploaded.
+"""
+
+import abc
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from os import environ
+
+logger = logging.getLogger(__name__)
+
+_BACKUP_DELAY = 60
+_DIGEST_CHUNK_SIZE = 1 << 20
+
+
+def _modified_time(path):
+    """The last time the database at `path` was written, or None if there is none."""
+    if not os.path.exists(path):
+        return None
+    # Recent writes may only be in the write-ahead log.
+    return max(os.path.getmtime(path + suffix) for suffix in ('', '-wal')
+               if os.path.exists(path + suffix))
+
+
+def _replace_database(path, new_path):
+    os.replace(new_path, path)
+    # A write-ahead log left over from the old file must not be applied to the new one.
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+class BackupBackend(abc.ABC):
+    """Where backups go. `upload` is called from a worker thread."""
+
+    @abc.abstractmethod
+    def upload(self, path):
+        """Store the database file at `path` as the backup."""
+
+    @abc.abstractmethod
+    def restore(self, path):
+        """Replace the database at `path` with the backup, if there is one and it is newer.
+        Returns whether the database was replaced."""
+
+
+class FirebaseBackend(BackupBackend):
+    def __init__(self, bucket, blob_name='tle.db'):
+        self.bucket = bucket
+        self.blob_name = blob_name
+
+    def upload(self, path):
+        self.bucket.blob(self.blob_name).upload_from_filename(path)
+
+    def restore(self, path):
+        blob = self.bucket.get_blob(self.blob_name)
+        if blob is None:
+            return False
+        local_time = _modified_time(path)
+        if local_time is not None and blob.updated.timestamp() <= local_time:
+            logger.info('Local database is newer than the backup, keeping it')
+            return False
+        blob.download_to_filename(path + '.restore')
+        _replace_database(path, path + '.restore')
+        return True
+
+
+class LocalDirBackend(BackupBackend):
+    """Keeps the backup in a local directory, for testing or for a mounted volume."""
+
+    def __init__(self, directory, name='tle.db'):
+        self.directory = directory
+        self.name = name
+
+    def upload(self, path):
+        os.makedirs(self.directory, exist_ok=True)
+        dest = os.path.join(self.directory, self.name)
+        shutil.copyfile(path, dest + '.tmp')
+        os.replace(dest + '.tmp', dest)
+
+    def restore(self, path):
+        src = os.path.join(self.directory, self.name)
+        if not os.path.exists(src):
+            return False
+        local_time = _modified_time(path)
+        if local_time is not None and os.path.getmtime(src) <= local_time:
+            logger.info('Local database is newer than the backup, keeping it')
+            return False
+        shutil.copyfile(src, path + '.restore')
+        _replace_database(path, path + '.restore')
+        return True
+
+
+def backend_from_env():
+    """The backend configured by the environment, or None if backups are disabled."""
+    if str(environ.get('STORAGE_BUCKET')) != 'None':
+        from firebase_admin import storage
+        return FirebaseBackend(storage.bucket())
+    if environ.get('BACKUP_DIR'):
+        return LocalDirBackend(environ['BACKUP_DIR'])
+    return None
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+class BackupManager:
+    def __init__(self, db_conn, backend, *, delay=_BACKUP_DELAY):
+        self.db_conn = db_conn
+        self.backend = backend
+        self.delay = delay
+        self.backup_path = f'{db_conn.db_file}.backup'
+        self._loop = None
+        self._loop_thread_id = None
+        self._dirty = False
+        self._flushing = False
+        self._flush_handle = None
+        self._last_digest = None
+
+    def start(self):
+        """Start making backups. Must be called from the event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        if self._dirty:
+            self._schedule()
+
+    def mark_dirty(self):
+        """Note that the database changed. The next backup, made at most `delay` seconds
+        later, includes the change. May be called from any thread."""
+        self._dirty = True
+        if self._loop is None:
+            return
+        if threading.get_ident() == self._loop_thread_id:
+            self._schedule()
+        else:
+            self._loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        if self._flush_handle is None and not self._flushing:
+            self._flush_handle = self._loop.call_later(self.delay, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._loop.create_task(self.flush())
+
+    async def flush(self):
+        """Back up the database now if it changed since the last backup."""
+        if not self._dirty or self._flushing:
+            return
+        self._flushing = True
+        self._dirty = False
+        try:
+            await self.db_conn.aio.backup_to(self.backup_path)
+            digest = await asyncio.to_thread(_file_digest, self.backup_path)
+            if digest != self._last_digest:
+                await asyncio.to_thread(self.backend.upload, self.backup_path)
+                self._last_digest = digest
+                logger.info('Database backup uploaded')
+        except Exception as e:
+            logger.warning(f'Database backup failed, will retry. {e!r}')
+            self._dirty = True
+        finally:
+            self._flushing = False
+            # Changes made during the backup need another one.
+            if self._dirty:
+                self._schedule()
+
+    def flush_sync(self):
+        """Back up the database right away, blocking. For use on shutdown."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+        self._dirty = False
+        self.db_conn.backup_to(self.backup_path)
+        self.backend.upload(self.backup_path)
@@ -1,12 +1,16 @@
 import json
-import sqlite3
+from collections import defaultdict
 
 from tle.util import codeforces_api as cf
+from tle.util.db.db_executor import ExecutorDbConn
 
 
-class CacheDbConn:
+class CacheDbConn(ExecutorDbConn):
+    # Tables that snapshots are built from, see `get_fingerprint`.
+    _FINGERPRINT_TABLES = ('contest', 'problem', 'rating_change', 'problem2')
+
     def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file)
+        super().__init__(db_file)
         self.create_tables()
 
     def create_tables(self):
@@ -53,8 +57,37 @@ class CacheDbConn:
         )
         self.conn.execute('CREATE INDEX IF NOT EXISTS ix_rating_change_contest_id '
                           'ON rating_change (contest_id)')
-        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_rating_change_handle '
-                          'ON rating_change (handle)')
+        # Handles are case-insensitive on Codeforces.
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_rating_change_handle_nocase '
+                          'ON rating_change (handle COLLATE NOCASE)')
+
+        # One row per handle in rating_change with their number of contests, the time of their
+        # latest contest and their rating after it. It is kept up to date by the methods that
+        # write rating changes, so that queries over all handles read one row per handle
+        # instead of their whole history.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS handle_summary ('
+            'handle             TEXT NOT NULL,'
+            'num_contests       INTEGER NOT NULL,'
+            'last_update_time   INTEGER,'
+            'rating             INTEGER,'
+            'PRIMARY KEY (handle)'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_handle_summary_last_update_time '
+                          'ON handle_summary (last_update_time)')
+
+        # Checkpoint for the rating changes backfill. A contest is recorded here once its rating
+        # changes have been fetched and saved, including contests which turned out to be unrated,
+        # so that an interrupted backfill resumes instead of starting over.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS rating_change_fetched ('
+            'contest_id     INTEGER NOT NULL,'
+            'fetch_time     INTEGER,'
+            'num_changes    INTEGER,'
+            'PRIMARY KEY (contest_id)'
+            ')'
+        )
 
         # Table for problems fetched from contest.standings endpoint for every contest.
         # This is separate from table problem as it contains the same problem twice if it
@@ -75,11 +108,161 @@ class CacheDbConn:
         self.conn.execute('CREATE INDEX IF NOT EXISTS ix_problem2_contest_id '
                           'ON problem2 (contest_id)')
 
+        # Problem tags. The tags column of problem and problem2 held them as JSON and is no
+        # longer used, each tag is stored once in table tag and problems refer to it by id.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS tag ('
+            'id     INTEGER PRIMARY KEY,'
+            'name   TEXT NOT NULL UNIQUE'
+            ')'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS problem_tag ('
+            'problem_name   TEXT NOT NULL,'
+            'position       INTEGER NOT NULL,'
+            'tag_id         INTEGER NOT NULL,'
+            'PRIMARY KEY (problem_name, position)'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_problem_tag_tag_id '
+                          'ON problem_tag (tag_id, problem_name)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_problem_rating '
+                          'ON problem (rating)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS problem2_tag ('
+            'contest_id     INTEGER,'
+            '[index]        TEXT,'
+            'position       INTEGER NOT NULL,'
+            'tag_id         INTEGER NOT NULL,'
+            'PRIMARY KEY (contest_id, [index], position)'
+            ') WITHOUT ROWID'
+        )
+
+        # A generation number for each table in _FINGERPRINT_TABLES, bumped in the same
+        # transaction as every write to the table. Generations start from a random number, so
+        # that a new database does not match the snapshots of an old one.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS table_generation ('
+            'name         TEXT NOT NULL,'
+            'generation   INTEGER NOT NULL,'
+            'PRIMARY KEY (name)'
+            ')'
+        )
+        self.conn.executemany('INSERT OR IGNORE INTO table_generation (name, generation) '
+                              'VALUES (?, ABS(RANDOM() % 1000000000000))',
+                              [(table,) for table in self._FINGERPRINT_TABLES])
+        self.conn.commit()
+        self._migrate()
+
+    def _migrate(self):
+        # The user_version of a database is the number of migrations applied to it.
+        migrations = (self._move_tags_to_tables, self._update_handle_summary,
+                      self._index_rating_update_time, self._drop_binary_handle_index)
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        for version, migration in enumerate(migrations[version:], start=version + 1):
+            with self.conn:
+                migration()
+                self.conn.execute(f'PRAGMA user_version = {version}')
+
+    def _move_tags_to_tables(self):
+        for table, key_columns, save_tags in (('problem', 'name', self._save_problem_tags),
+                                              ('problem2', 'contest_id, [index]',
+                                               self._save_problem2_tags)):
+            query = f'SELECT {key_columns}, tags FROM {table} WHERE tags IS NOT NULL'
+            rows = self.conn.execute(query).fetchall()
+            save_tags([(*key, json.loads(tags)) for *key, tags in rows])
+            self.conn.execute(f'UPDATE {table} SET tags = NULL')
+        self._bump_generation('problem', 'problem2')
+
+    def _index_rating_update_time(self):
+        # Rating changes are read in the order they were rated, without it that takes a sort
+        # of the whole table.
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_rating_change_update_time '
+                          'ON rating_change (rating_update_time, contest_id)')
+
+    def _drop_binary_handle_index(self):
+        # Replaced by ix_rating_change_handle_nocase.
+        self.conn.execute('DROP INDEX IF EXISTS ix_rating_change_handle')
+
+    def _update_handle_summary(self, handles=None):
+        """Recomputes the summary of `handles` from their rating changes, or the summary of
+        every handle if `handles` is None. Does not commit."""
+        # With a single MAX, SQLite takes the bare column new_rating from the row with the
+        # latest time.
+        select = ('SELECT handle, COUNT(*), MAX(rating_update_time), new_rating '
+                  'FROM rating_change ')
+        if handles is None:
+            self.conn.execute('DELETE FROM handle_summary')
+            self.conn.execute('INSERT INTO handle_summary '
+                              '(handle, num_contests, last_update_time, rating) ' +
+                              select + 'GROUP BY handle')
+            return
+        handles = [(handle,) for handle in set(handles)]
+        self.conn.executemany('DELETE FROM handle_summary WHERE handle = ?', handles)
+        # Compared without case to use the handle index, which may also select the other
+        # spellings of a handle. Their summaries are recomputed as well, hence the REPLACE.
+        self.conn.executemany('INSERT OR REPLACE INTO handle_summary '
+                              '(handle, num_contests, last_update_time, rating) ' +
+                              select + 'WHERE handle = ? COLLATE NOCASE GROUP BY handle',
+                              handles)
+
+    def _save_rating_change_tuples(self, change_tuples):
+        """Saves rating changes and updates the handle summary. Does not commit."""
+        # Changes that replace a saved one are rare, the summary of their handles is recomputed.
+        # Every other change is added to the summary of its handle.
+        saved = set()
+        for contest_id in {contest_id for contest_id, *_ in change_tuples}:
+            saved.update((contest_id, handle) for handle, in self.conn.execute(
+                'SELECT handle FROM rating_change WHERE contest_id = ?', (contest_id,)))
+        replaced_handles = [handle for contest_id, handle, *_ in change_tuples
+                            if (contest_id, handle) in saved]
+        new_tuples = [change for change in change_tuples if change[:2] not in saved]
+
+        query = ('INSERT OR REPLACE INTO rating_change '
+                 '(contest_id, handle, rank, rating_update_time, old_rating, new_rating) '
+                 'VALUES (?, ?, ?, ?, ?, ?)')
+        rc = self.conn.executemany(query, change_tuples).rowcount
+
+        summary = {}
+        for _, handle, _, update_time, _, new_rating in new_tuples:
+            num_contests, last_update_time, rating = summary.get(handle, (0, None, None))
+            if last_update_time is None or update_time >= last_update_time:
+                last_update_time, rating = update_time, new_rating
+            summary[handle] = num_contests + 1, last_update_time, rating
+        query = ('INSERT INTO handle_summary (handle, num_contests, last_update_time, rating) '
+                 'VALUES (?, ?, ?, ?) '
+                 'ON CONFLICT (handle) DO UPDATE SET '
+                 'num_contests = num_contests + excluded.num_contests, '
+                 'last_update_time = MAX(last_update_time, excluded.last_update_time), '
+                 'rating = CASE WHEN excluded.last_update_time >= last_update_time '
+                 'THEN excluded.rating ELSE rating END')
+        self.conn.executemany(query, [(handle, *row) for handle, row in summary.items()])
+        self._update_handle_summary(replaced_handles)
+        self._bump_generation('rating_change')
+        return rc
+
+    def _bump_generation(self, *tables):
+        """Marks `tables` as changed. Must run in the transaction of the write."""
+        self.conn.executemany('UPDATE table_generation SET generation = generation + 1 '
+                              'WHERE name = ?', [(table,) for table in tables])
+
+    def get_fingerprint(self, *tables):
+        """Returns a cheap fingerprint of the given tables which changes whenever rows are
+        inserted, replaced or deleted through this class.
+        """
+        for table in tables:
+            if table not in self._FINGERPRINT_TABLES:
+                raise ValueError(f'Unknown table {table}')
+        generation_by_table = dict(self.conn.execute('SELECT name, generation '
+                                                     'FROM table_generation'))
+        return tuple((table, generation_by_table[table]) for table in tables)
+
     def cache_contests(self, contests):
         query = ('INSERT OR REPLACE INTO contest '
                  '(id, name, start_time, duration, type, phase, prepared_by) '
                  'VALUES (?, ?, ?, ?, ?, ?, ?)')
         rc = self.conn.executemany(query, contests).rowcount
+        self._bump_generation('contest')
         self.conn.commit()
         return rc
 
@@ -90,59 +273,172 @@ class CacheDbConn:
         return [cf.Contest._make(contest) for contest in res]
 
     @staticmethod
-    def _squish_tags(problem):
+    def _problem_tuple(problem):
         return (problem.contestId, problem.problemsetName, problem.index, problem.name,
-                problem.type, problem.points, problem.rating, json.dumps(problem.tags))
+                problem.type, problem.points, problem.rating)
+
+    def _get_tag_ids(self, names):
+        """Returns a dict mapping each of `names` to its tag id, adding new tags."""
+        self.conn.executemany('INSERT OR IGNORE INTO tag (name) VALUES (?)',
+                              [(name,) for name in set(names)])
+        return {name: tag_id for tag_id, name in self.conn.execute('SELECT id, name FROM tag')}
+
+    def _tags_by_key(self, query, params=()):
+        """Runs `query` for rows of key columns followed by a tag id, and returns a dict mapping
+        each key tuple to its list of tag names. Problems share the tag name strings."""
+        name_by_id = dict(self.conn.execute('SELECT id, name FROM tag'))
+        tags_by_key = defaultdict(list)
+        for *key, tag_id in self.conn.execute(query, params):
+            tags_by_key[tuple(key)].append(name_by_id[tag_id])
+        return tags_by_key
+
+    def _save_problem_tags(self, name_tags):
+        """Replaces the tags of problems, given as (name, tags) pairs."""
+        tag_ids = self._get_tag_ids(tag for _, tags in name_tags for tag in tags)
+        self.conn.executemany('DELETE FROM problem_tag WHERE problem_name = ?',
+                              [(name,) for name, _ in name_tags])
+        self.conn.executemany('INSERT OR REPLACE INTO problem_tag (problem_name, position, tag_id) '
+                              'VALUES (?, ?, ?)',
+                              [(name, position, tag_ids[tag]) for name, tags in name_tags
+                               for position, tag in enumerate(tags)])
+
+    def _save_problem2_tags(self, key_tags):
+        """Replaces the tags of problemset problems, given as (contest id, index, tags)."""
+        tag_ids = self._get_tag_ids(tag for _, _, tags in key_tags for tag in tags)
+        self.conn.executemany('DELETE FROM problem2_tag WHERE contest_id = ? AND [index] = ?',
+                              [(contest_id, index) for contest_id, index, _ in key_tags])
+        self.conn.executemany('INSERT OR REPLACE INTO problem2_tag '
+                              '(contest_id, [index], position, tag_id) '
+                              'VALUES (?, ?, ?, ?)',
+                              [(contest_id, index, position, tag_ids[tag])
+                               for contest_id, index, tags in key_tags
+                               for position, tag in enumerate(tags)])
 
     def cache_problems(self, problems):
         query = ('INSERT OR REPLACE INTO problem '
-                 '(contest_id, problemset_name, [index], name, type, points, rating, tags) '
-                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
-        rc = self.conn.executemany(query, list(map(self._squish_tags, problems))).rowcount
+                 '(contest_id, problemset_name, [index], name, type, points, rating) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?)')
+        rc = self.conn.executemany(query, list(map(self._problem_tuple, problems))).rowcount
+        self._save_problem_tags([(problem.name, problem.tags) for problem in problems])
+        self._bump_generation('problem')
         self.conn.commit()
         return rc
 
-    @staticmethod
-    def _unsquish_tags(problem):
-        args, tags = problem[:-1], json.loads(problem[-1])
-        return cf.Problem(*args, tags)
-
     def fetch_problems(self):
-        query = ('SELECT contest_id, problemset_name, [index], name, type, points, rating, tags '
+        query = ('SELECT contest_id, problemset_name, [index], name, type, points, rating '
                  'FROM problem')
         res = self.conn.execute(query).fetchall()
-        return list(map(self._unsquish_tags, res))
+        tags_by_key = self._tags_by_key('SELECT problem_name, tag_id FROM problem_tag '
+                                        'ORDER BY problem_name, position')
+        return [cf.Problem(*problem, tags_by_key.get((problem[3],), [])) for problem in res]
+
+    def get_tag_names(self):
+        query = 'SELECT name FROM tag'
+        return [name for name, in self.conn.execute(query)]
+
+    def query_problem_names(self, *, tags=(), notags=(), rating_min=None, rating_max=None):
+        """Returns the names of problems in table problem with a rating in the given range, and
+        with tags matching all of `tags` and none of `notags`. As with `Problem.tag_matches`, a
+        query tag matches the tags it is a substring of."""
+        all_tags = dict(self.conn.execute('SELECT name, id FROM tag'))
+
+        def matching_ids(query_tag):
+            return [tag_id for name, tag_id in all_tags.items() if query_tag in name]
+
+        conditions, params = [], []
+        if rating_min is not None:
+            conditions.append('rating >= ?')
+            params.append(rating_min)
+        if rating_max is not None:
+            conditions.append('rating <= ?')
+            params.append(rating_max)
+        for query_tag in tags:
+            tag_ids = matching_ids(query_tag)
+            if not tag_ids:
+                return []
+            conditions.append('name IN (SELECT problem_name FROM problem_tag WHERE tag_id IN ({}))'
+                              .format(', '.join(['?'] * len(tag_ids))))
+            params += tag_ids
+        notag_ids = [tag_id for query_tag in notags for tag_id in matching_ids(query_tag)]
+        if notag_ids:
+            conditions.append('name NOT IN (SELECT problem_name FROM problem_tag WHERE tag_id IN ({}))'
+                              .format(', '.join(['?'] * len(notag_ids))))
+            params += notag_ids
+        query = 'SELECT name FROM problem'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return [name for name, in self.conn.execute(query, params)]
+
+    @staticmethod
+    def _rating_change_tuple(change):
+        return (change.contestId, change.handle, change.rank, change.ratingUpdateTimeSeconds,
+                change.oldRating, change.newRating)
 
     def save_rating_changes(self, changes):
-        change_tuples = [(change.contestId,
-                          change.handle,
-                          change.rank,
-                          change.ratingUpdateTimeSeconds,
-                          change.oldRating,
-                          change.newRating) for change in changes]
-        query = ('INSERT OR REPLACE INTO rating_change '
-                 '(contest_id, handle, rank, rating_update_time, old_rating, new_rating) '
-                 'VALUES (?, ?, ?, ?, ?, ?)')
-        rc = self.conn.executemany(query, change_tuples).rowcount
-        self.conn.commit()
+        change_tuples = list(map(self._rating_change_tuple, changes))
+        with self.conn:
+            rc = self._save_rating_change_tuples(change_tuples)
+        return rc
+
+    def save_rating_changes_batch(self, changes, fetched, fetch_time):
+        """Saves a batch of rating changes and marks the contests in `fetched`, a list of
+        (contest id, number of changes) pairs, as done in a single transaction."""
+        change_tuples = list(map(self._rating_change_tuple, changes))
+        query_fetched = ('INSERT OR REPLACE INTO rating_change_fetched '
+                         '(contest_id, fetch_time, num_changes) '
+                         'VALUES (?, ?, ?)')
+        with self.conn:
+            rc = self._save_rating_change_tuples(change_tuples)
+            self.conn.executemany(query_fetched, [(contest_id, fetch_time, num_changes)
+                                                  for contest_id, num_changes in fetched])
         return rc
 
+    def get_contests_without_rating_changes(self):
+        """Returns ids of finished contests that neither have rating changes saved nor are
+        recorded as fetched, ordered by start time."""
+        query = ('SELECT c.id '
+                 'FROM contest c '
+                 'WHERE c.phase = \'FINISHED\' '
+                 'AND NOT EXISTS (SELECT 1 FROM rating_change r WHERE r.contest_id = c.id) '
+                 'AND NOT EXISTS (SELECT 1 FROM rating_change_fetched f WHERE f.contest_id = c.id) '
+                 'ORDER BY c.start_time, c.id')
+        res = self.conn.execute(query).fetchall()
+        return [contest_id for contest_id, in res]
+
     def clear_rating_changes(self, contest_id=None):
-        if contest_id is None:
-            query = 'DELETE FROM rating_change'
-            self.conn.execute(query)
-        else:
-            query = 'DELETE FROM rating_change WHERE contest_id = ?'
-            self.conn.execute(query, (contest_id,))
-        self.conn.commit()
+        with self.conn:
+            if contest_id is None:
+                self.conn.execute('DELETE FROM rating_change')
+                self.conn.execute('DELETE FROM rating_change_fetched')
+                self.conn.execute('DELETE FROM handle_summary')
+            else:
+                handles = [handle for handle, in self.conn.execute(
+                    'SELECT handle FROM rating_change WHERE contest_id = ?', (contest_id,))]
+                self.conn.execute('DELETE FROM rating_change WHERE contest_id = ?', (contest_id,))
+                self.conn.execute('DELETE FROM rating_change_fetched WHERE contest_id = ?',
+                                  (contest_id,))
+                self._update_handle_summary(handles)
+            self._bump_generation('rating_change')
 
     def get_users_with_more_than_n_contests(self, time_cutoff, n):
-        query = ('SELECT handle, COUNT(*) AS num_contests '
-                 'FROM rating_change GROUP BY handle HAVING num_contests >= ? '
-                 'AND MAX(rating_update_time) >= ?')
+        query = ('SELECT handle FROM handle_summary '
+                 'WHERE num_contests >= ? AND last_update_time >= ?')
         res = self.conn.execute(query, (n, time_cutoff,)).fetchall()
         return [user[0] for user in res]
 
+    def get_ratings_of_users_with_more_than_n_contests(self, time_cutoff, n):
+        """Returns the current ratings of the handles with at least `n` contests, the latest of
+        them at or after `time_cutoff`."""
+        query = ('SELECT rating FROM handle_summary '
+                 'WHERE num_contests >= ? AND last_update_time >= ?')
+        res = self.conn.execute(query, (n, time_cutoff,)).fetchall()
+        return [rating for rating, in res]
+
+    def get_latest_ratings(self):
+        """Returns a dict mapping every handle to their rating after their latest contest."""
+        query = 'SELECT handle, rating FROM handle_summary'
+        return dict(self.conn.execute(query))
+
     def get_all_rating_changes(self):
         query = ('SELECT contest_id, name, handle, rank, rating_update_time, old_rating, new_rating '
                  'FROM rating_change r '
@@ -152,6 +448,29 @@ class CacheDbConn:
         res = self.conn.execute(query)
         return (cf.RatingChange._make(change) for change in res)
 
+    def get_rated_contest_ids(self):
+        """Returns the ids of the contests with rating changes, in the order they were rated."""
+        query = ('SELECT contest_id '
+                 'FROM rating_change '
+                 'GROUP BY contest_id '
+                 'ORDER BY MIN(rating_update_time), contest_id')
+        return [contest_id for contest_id, in self.conn.execute(query)]
+
+    def get_rating_change_rows_for_contest(self, contest_id):
+        """Returns the rating changes of a contest as (handle, rank, old rating, new rating)
+        tuples."""
+        query = ('SELECT handle, rank, old_rating, new_rating '
+                 'FROM rating_change '
+                 'WHERE contest_id = ?')
+        return self.conn.execute(query, (contest_id,)).fetchall()
+
+    def iter_rating_changes_by_contest(self):
+        """Yields (contest id, rows) for every contest with rating changes, in the order the
+        contests were rated, with rows as returned by `get_rating_change_rows_for_contest`. One
+        contest is held in memory at a time, and no query is left open between two of them."""
+        for contest_id in self.get_rated_contest_ids():
+            yield contest_id, self.get_rating_change_rows_for_contest(contest_id)
+
     def get_rating_changes_for_contest(self, contest_id):
         query = ('SELECT contest_id, name, handle, rank, rating_update_time, old_rating, new_rating '
                  'FROM rating_change r '
@@ -173,43 +492,52 @@ class CacheDbConn:
                  'FROM rating_change r '
                  'LEFT JOIN contest c '
                  'ON r.contest_id = c.id '
-                 'WHERE r.handle = ?')
+                 'WHERE r.handle = ? COLLATE NOCASE '
+                 'ORDER BY rating_update_time')
         res = self.conn.execute(query, (handle,)).fetchall()
         return [cf.RatingChange._make(change) for change in res]
 
     def cache_problemset(self, problemset):
         query = ('INSERT OR REPLACE INTO problem2 '
-                 '(contest_id, problemset_name, [index], name, type, points, rating, tags) '
-                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
-        rc = self.conn.executemany(query, list(map(self._squish_tags, problemset))).rowcount
+                 '(contest_id, problemset_name, [index], name, type, points, rating) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?)')
+        rc = self.conn.executemany(query, list(map(self._problem_tuple, problemset))).rowcount
+        self._save_problem2_tags([(problem.contestId, problem.index, problem.tags)
+                                  for problem in problemset])
+        self._bump_generation('problem2')
         self.conn.commit()
         return rc
 
     def fetch_problems2(self):
-        query = ('SELECT contest_id, problemset_name, [index], name, type, points, rating, tags '
+        query = ('SELECT contest_id, problemset_name, [index], name, type, points, rating '
                  'FROM problem2 ')
         res = self.conn.execute(query).fetchall()
-        return list(map(self._unsquish_tags, res))
+        tags_by_key = self._tags_by_key('SELECT contest_id, [index], tag_id FROM problem2_tag '
+                                        'ORDER BY contest_id, [index], position')
+        return [cf.Problem(*problem, tags_by_key.get((problem[0], problem[2]), []))
+                for problem in res]
 
     def clear_problemset(self, contest_id=None):
         if contest_id is None:
-            query = 'DELETE FROM problem2'
-            self.conn.execute(query)
+            self.conn.execute('DELETE FROM problem2')
+            self.conn.execute('DELETE FROM problem2_tag')
         else:
-            query = 'DELETE FROM problem2 WHERE contest_id = ?'
-            self.conn.execute(query, (contest_id,))
+            self.conn.execute('DELETE FROM problem2 WHERE contest_id = ?', (contest_id,))
+            self.conn.execute('DELETE FROM problem2_tag WHERE contest_id = ?', (contest_id,))
+        self._bump_generation('problem2')
 
     def fetch_problemset(self, contest_id):
-        query = ('SELECT contest_id, problemset_name, [index], name, type, points, rating, tags '
+        query = ('SELECT contest_id, problemset_name, [index], name, type, points, rating '
                  'FROM problem2 '
                  'WHERE contest_id = ?')
         res = self.conn.execute(query, (contest_id,)).fetchall()
-        return list(map(self._unsquish_tags, res))
+        tags_by_key = self._tags_by_key('SELECT contest_id, [index], tag_id FROM problem2_tag '
+                                        'WHERE contest_id = ? '
+                                        'ORDER BY [index], position', (contest_id,))
+        return [cf.Problem(*problem, tags_by_key.get((problem[0], problem[2]), []))
+                for problem in res]
 
     def problemset_empty(self):
         query = 'SELECT 1 FROM problem2'
         res = self.conn.execute(query).fetchone()
         return res is None
-
-    def close(self):
-        self.conn.close()
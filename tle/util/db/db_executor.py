@@ -0,0 +1,102 @@
+"""
+    Running database methods off the event loop.
+
+    The connection classes keep their synchronous methods, which is fine for small queries. Big
+    reads and writes can instead be awaited through `aio`, which runs the very same method on a
+    dedicated thread. That thread has a connection of its own, and `conn` always returns the
+    connection of the calling thread, so the methods need no changes. Both connections use WAL,
+    so readers on the event loop are not blocked by a write in progress on the thread. The cache
+    database makes all of its writes through `aio`, so the thread is its only writer and a write
+    never waits on the event loop for a lock.
+"""
+
+import asyncio
+import functools
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    # With WAL this only risks the last transactions on power loss, never corruption.
+    'PRAGMA synchronous = NORMAL',
+    # In KiB.
+    'PRAGMA cache_size = -32000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+)
+# Seconds to wait for the other connection's write to finish.
+_BUSY_TIMEOUT = 30
+
+
+def connect(db_file, factory=sqlite3.Connection):
+    conn = sqlite3.connect(db_file, timeout=_BUSY_TIMEOUT, check_same_thread=False,
+                           factory=factory)
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class _AsyncMethods:
+    def __init__(self, db_conn):
+        self._db_conn = db_conn
+
+    def __getattr__(self, name):
+        method = getattr(self._db_conn, name)
+        if not callable(method):
+            raise AttributeError(f'`{name}` is not a method')
+
+        @functools.wraps(method)
+        async def run_in_thread(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._db_conn._executor,
+                                              functools.partial(method, *args, **kwargs))
+
+        return run_in_thread
+
+
+class ExecutorDbConn:
+    """Base for the database connection classes. `self.conn` is the connection of the calling
+    thread, and `await self.aio.method(...)` runs `self.method(...)` on the database thread."""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._loop_conn = self._connect()
+        self._thread_conn = None
+        self._thread_id = None
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix=self.__class__.__name__,
+                                            initializer=self._init_thread)
+        self.aio = _AsyncMethods(self)
+
+    def _connect(self):
+        return connect(self.db_file)
+
+    def _init_thread(self):
+        self._thread_conn = self._connect()
+        self._thread_id = threading.get_ident()
+
+    @property
+    def conn(self):
+        if self._thread_id is not None and threading.get_ident() == self._thread_id:
+            return self._thread_conn
+        return self._loop_conn
+
+    def backup_to(self, path):
+        """Write a consistent copy of the database to `path` using SQLite's online backup."""
+        # Start from scratch, backing up into an existing database changes its header even if
+        # the data is the same.
+        if os.path.exists(path):
+            os.remove(path)
+        dest = sqlite3.connect(path)
+        try:
+            self.conn.backup(dest)
+        finally:
+            dest.close()
+
+    def close(self):
+        if self._thread_conn is not None:
+            self._executor.submit(self._thread_conn.close).result()
+        self._executor.shutdown()
+        self._loop_conn.close()
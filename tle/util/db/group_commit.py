@@ -0,0 +1,63 @@
+"""
+    Group commit for writes of background loops.
+
+    A loop that goes over every user of every guild writes a row at a time, and committing each
+    one costs a write to disk. Such writes can instead be handed to a `GroupCommitter`, which
+    runs them shortly after, all in one transaction. A write that fails is rolled back on its
+    own and does not affect the others.
+
+    Commands should keep writing directly, so that they see their own writes right away.
+"""
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for more writes before committing.
+_COMMIT_DELAY = 1
+_MAX_PENDING = 500
+
+
+class GroupCommitter:
+    def __init__(self, db_conn, *, delay=_COMMIT_DELAY, max_pending=_MAX_PENDING):
+        self.db_conn = db_conn
+        self.delay = delay
+        self.max_pending = max_pending
+        self._pending = []
+        self._flush_handle = None
+
+    def execute(self, query, params=()):
+        """Run `query` with the next group."""
+        self.call(self.db_conn.conn.execute, query, params)
+
+    def call(self, func, *args):
+        """Call `func(*args)` with the next group, where `func` writes to `db_conn`. Must be
+        called from the event loop, or outside of one, in which case it runs right away."""
+        self._pending.append((func, args))
+        if len(self._pending) >= self.max_pending:
+            self.flush()
+            return
+        if self._flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self._flush_handle = loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        """Commit the pending writes now."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        with self.db_conn.transaction():
+            for func, args in pending:
+                try:
+                    with self.db_conn.transaction():
+                        func(*args)
+                except Exception as e:
+                    logger.warning(f'Write of {func.__name__} failed, skipping it. {e!r}')
@@ -1,3 +1,5 @@
+import contextlib
+import functools
 import sqlite3
 from enum import IntEnum
 from collections import namedtuple
@@ -6,14 +8,8 @@ from typing import List
 from discord.ext import commands
 
 from tle.util import codeforces_api as cf
-
-from os import environ
-from firebase_admin import storage
-from tle import constants
-bucket = None
-STORAGE_BUCKET = str(environ.get('STORAGE_BUCKET'))
-if STORAGE_BUCKET!='None':
-    bucket = storage.bucket()
+from tle.util.db.db_executor import ExecutorDbConn, connect
+from tle.util.db.group_commit import GroupCommitter
 
 _DEFAULT_VC_RATING = 100
 
@@ -62,25 +58,202 @@ class UniqueConstraintFailed(UserDbError):
     pass
 
 
+# The description of the last cursor seen by namedtuple_factory and its row class. A cursor
+# keeps the same description object for all rows of a query.
+_last_row_class = (None, None)
+
+
+@functools.lru_cache(maxsize=256)
+def _make_row_class(fields):
+    return namedtuple("Row", fields)
+
+
 def namedtuple_factory(cursor, row):
-    """Returns sqlite rows as named tuples."""
-    fields = [col[0] for col in cursor.description if col[0].isidentifier()]
-    Row = namedtuple("Row", fields)
+    """Returns sqlite rows as named tuples. Queries with the same columns share a row class."""
+    global _last_row_class
+    description, Row = _last_row_class
+    if cursor.description is not description:
+        description = cursor.description
+        Row = _make_row_class(tuple(col[0] for col in description if col[0].isidentifier()))
+        _last_row_class = (description, Row)
     return Row(*row)
 
 
-class UserDbConn:
+# Schema changes for existing databases, applied in order by `UserDbConn.create_tables`. The
+# user_version of a database is the number of migrations already applied to it.
+_MIGRATIONS = (
+    # 1: Indexes for the duel, gitgud and rated VC lookups. The other hot tables are only
+    # queried by their primary key.
+    (
+        # Queries on the duels of a user check either side with OR, which SQLite answers with
+        # one index per side.
+        'CREATE INDEX IF NOT EXISTS ix_duel_challenger_status ON duel (challenger, status)',
+        'CREATE INDEX IF NOT EXISTS ix_duel_challengee_status ON duel (challengee, status)',
+        'CREATE INDEX IF NOT EXISTS ix_duel_status_start_time ON duel (status, start_time)',
+        'CREATE INDEX IF NOT EXISTS ix_challenge_finish_time '
+        'ON challenge (finish_time, user_id, rating_delta)',
+        'CREATE INDEX IF NOT EXISTS ix_challenge_user_id_status ON challenge (user_id, status)',
+        'CREATE INDEX IF NOT EXISTS ix_rated_vcs_status ON rated_vcs (status)',
+        # Without statistics SQLite may pick the status index for the duels of a user.
+        'ANALYZE',
+    ),
+)
+
+
+class _Connection(sqlite3.Connection):
+    """A connection that leaves committing to the outermost unit of work, see
+    `UserDbConn.transaction`."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Names of the savepoints of the open units of work, outermost first.
+        self.savepoints = []
+        # Guild ids and lowercased handles whose in-memory entries in `UserDbConn` were updated
+        # by the open units of work. They are dropped if a unit rolls back.
+        self.unit_guild_ids = set()
+        self.unit_cf_handles = set()
+        # Called after every commit that wrote something, from the committing thread.
+        self.on_commit = None
+
+    def _committed(self):
+        if self.on_commit is not None:
+            self.on_commit()
+
+    def commit(self):
+        if not self.savepoints:
+            changed = self.in_transaction
+            super().commit()
+            if changed:
+                self._committed()
+
+    def rollback(self):
+        if not self.savepoints:
+            super().rollback()
+        else:
+            # Undo what was done in the innermost unit so far, which stays open.
+            self.execute(f'ROLLBACK TO {self.savepoints[-1]}')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # `with conn:` commits or rolls back without going through the methods above.
+        if not self.savepoints:
+            changed = self.in_transaction
+            result = super().__exit__(exc_type, exc_value, traceback)
+            if changed and exc_type is None:
+                self._committed()
+            return result
+        if exc_type is not None:
+            self.rollback()
+        return False
+
+
+def _atomic(method):
+    """Runs the method in a unit of work of its own, so that when it rolls back inside a bigger
+    unit, only its own writes are undone."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _GuildHandles:
+    """The user_handle rows of one guild, kept in memory by `UserDbConn`. User ids are strings,
+    as in the table."""
+    __slots__ = ('handle_by_user_id', 'active_user_id_by_handle')
+
+    def __init__(self, rows):
+        # user_id -> (handle, active)
+        self.handle_by_user_id = {}
+        # lowercased handle -> user_id, for active users only
+        self.active_user_id_by_handle = {}
+        for user_id, handle, active in rows:
+            self.set(user_id, handle, active)
+
+    def set(self, user_id, handle, active):
+        self.remove(user_id)
+        self.handle_by_user_id[user_id] = (handle, active)
+        if active and handle:
+            self.active_user_id_by_handle[handle.lower()] = user_id
+
+    def set_inactive(self, user_id):
+        entry = self.handle_by_user_id.get(user_id)
+        if entry is not None:
+            self.set(user_id, entry[0], 0)
+
+    def remove(self, user_id):
+        entry = self.handle_by_user_id.pop(user_id, None)
+        if entry is None or not entry[0]:
+            return
+        lower = entry[0].lower()
+        if self.active_user_id_by_handle.get(lower) == user_id:
+            del self.active_user_id_by_handle[lower]
+
+
+class UserDbConn(ExecutorDbConn):
+    # Most parameters SQLite allows in one query by default.
+    _MAX_QUERY_PARAMS = 999
+
     def __init__(self, dbfile):
-        self.conn = sqlite3.connect(dbfile)
-        self.conn.row_factory = namedtuple_factory
+        super().__init__(dbfile)
+        # A `backup.BackupManager`, if backups are enabled.
+        self.backup = None
+        # Handles are looked up all the time and rarely change, so the user_handle rows of a
+        # guild are loaded on first use and updated along with the table. The same goes for
+        # cf_user_cache, keyed by lowercased handle.
+        self._guild_handles = {}
+        self._cf_user_by_handle = {}
+        # Writes of background loops, committed in batches.
+        self.group_commit = GroupCommitter(self)
         self.create_tables()
+
+    def _connect(self):
+        conn = connect(self.db_file, factory=_Connection)
+        conn.row_factory = namedtuple_factory
+        # Every write schedules a backup, including those of callers that commit on their own.
+        conn.on_commit = self.update
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """A unit of work. Everything done inside the block, including by methods that commit on
+        their own, is committed at the end of the outermost block, or rolled back if the block
+        raises. Reads inside see the writes made so far.
+
+        The block holds the write lock of the database, so it must not await."""
+        conn = self.conn
+        name = f'unit_{len(conn.savepoints)}'
+        if not conn.savepoints and not conn.in_transaction:
+            conn.execute('BEGIN')
+        conn.execute(f'SAVEPOINT {name}')
+        conn.savepoints.append(name)
+        try:
+            yield
+        except:
+            conn.execute(f'ROLLBACK TO {name}')
+            conn.execute(f'RELEASE {name}')
+            conn.savepoints.pop()
+            # The in-memory entries may hold writes that were just undone, they are reloaded on
+            # next use. The outer units still track them, they may roll back as well.
+            for guild_id in conn.unit_guild_ids:
+                self._guild_handles.pop(guild_id, None)
+            for lower in conn.unit_cf_handles:
+                self._cf_user_by_handle.pop(lower, None)
+            if not conn.savepoints:
+                conn.rollback()
+                conn.unit_guild_ids.clear()
+                conn.unit_cf_handles.clear()
+            raise
+        conn.execute(f'RELEASE {name}')
+        conn.savepoints.pop()
+        conn.commit()
+        if not conn.savepoints:
+            conn.unit_guild_ids.clear()
+            conn.unit_cf_handles.clear()
     
-    # update the data in firebase
+    # schedule a backup of the data
     def update(self):
-        if bucket==None:
-            return
-        blob = bucket.blob('tle.db')
-        blob.upload_from_filename(constants.USER_DB_FILE_PATH)
+        if self.backup is not None:
+            self.backup.mark_dirty()
 
     def create_tables(self):
         self.conn.execute(
@@ -305,7 +478,20 @@ class UserDbConn:
                 FOREIGN KEY (duel_id) REFERENCES duel(id)
             )
         ''')
-
+        self._migrate()
+
+    def _migrate(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        for version, statements in enumerate(_MIGRATIONS[version:], start=version + 1):
+            self.conn.execute('BEGIN')
+            try:
+                for statement in statements:
+                    self.conn.execute(statement)
+                self.conn.execute(f'PRAGMA user_version = {version}')
+            except:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
 
     # Helper functions.
 
@@ -339,6 +525,23 @@ class UserDbConn:
         self.conn.row_factory = None
         return res
 
+    def _fetch_tuples(self, query: str, params=()):
+        """Returns all rows as plain tuples, whatever the connection's row factory. Use this for
+        large results."""
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        return cursor.execute(query, params).fetchall()
+
+    def _fetch_columns(self, query: str, params=()):
+        """Returns the result as one list per column."""
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(query, params).fetchall()
+        if not rows:
+            return [[] for _ in cursor.description]
+        return [list(column) for column in zip(*rows)]
+
+    @_atomic
     def new_challenge(self, user_id, issue_time, prob, delta):
         query1 = '''
             INSERT INTO challenge
@@ -386,8 +589,10 @@ class UserDbConn:
         return c_id, issue_time, res[0], res[1], res[2], res[3]
 
     def get_gudgitters_last(self, timestamp):
+        # The + keeps SQLite from walking the whole table in user_id order to skip the sort,
+        # recent challenges are a small part of the table.
         query = '''
-            SELECT user_id, rating_delta FROM challenge WHERE finish_time >= ? ORDER BY user_id
+            SELECT user_id, rating_delta FROM challenge WHERE finish_time >= ? ORDER BY +user_id
         '''
         return self.conn.execute(query, (timestamp,)).fetchall()
         
@@ -422,6 +627,7 @@ class UserDbConn:
         '''
         return self.conn.execute(query, (user_id,)).fetchall()
 
+    @_atomic
     def complete_challenge(self, user_id, challenge_id, finish_time, delta):
         query1 = f'''
             UPDATE challenge SET finish_time = ?, status = {Gitgud.GOTGUD}
@@ -444,6 +650,7 @@ class UserDbConn:
         self.update()
         return 1
 
+    @_atomic
     def skip_challenge(self, user_id, challenge_id, status):
         query1 = '''
             UPDATE user_challenge SET active_challenge_id = NULL, issue_time = NULL
@@ -464,6 +671,27 @@ class UserDbConn:
         self.update()
         return 1
 
+    def _get_guild_handles(self, guild_id):
+        guild_id = str(guild_id)
+        guild_handles = self._guild_handles.get(guild_id)
+        if guild_handles is None:
+            query = ('SELECT user_id, handle, active '
+                     'FROM user_handle '
+                     'WHERE guild_id = ?')
+            guild_handles = _GuildHandles(self._fetch_tuples(query, (guild_id,)))
+            self._guild_handles[guild_id] = guild_handles
+        return guild_handles
+
+    def _invalidate_guild_handles(self, guild_id):
+        self._guild_handles.pop(str(guild_id), None)
+        # Reloaded inside a unit of work, the entries would include its uncommitted writes.
+        self._track_guild_handles(guild_id)
+
+    def _track_guild_handles(self, guild_id):
+        """Notes that the in-memory handles of the guild were changed, for `transaction`."""
+        if self.conn.savepoints:
+            self.conn.unit_guild_ids.add(str(guild_id))
+
     def cache_cf_user(self, user):
         query = ('INSERT OR REPLACE INTO cf_user_cache '
                  '(handle, first_name, last_name, country, city, organization, contribution, '
@@ -472,15 +700,30 @@ class UserDbConn:
         res = None
         with self.conn:
             res = self.conn.execute(query, user).rowcount
+        user = cf.User._make(user)
+        self._cf_user_by_handle[user.handle.lower()] = user
+        if self.conn.savepoints:
+            self.conn.unit_cf_handles.add(user.handle.lower())
         return res
 
     def fetch_cf_user(self, handle):
-        query = ('SELECT handle, first_name, last_name, country, city, organization, contribution, '
-                 '    rating, maxRating, last_online_time, registration_time, friend_of_count, title_photo '
-                 'FROM cf_user_cache '
-                 'WHERE UPPER(handle) = UPPER(?)')
-        user = self.conn.execute(query, (handle,)).fetchone()
-        return cf.User._make(user) if user else None
+        return self.fetch_cf_users([handle])[0]
+
+    def fetch_cf_users(self, handles):
+        """Returns the cached user for each of `handles`, or None for handles not cached."""
+        lowers = [handle.lower() if handle is not None else None for handle in handles]
+        missing = list({lower for lower in lowers
+                        if lower is not None and lower not in self._cf_user_by_handle})
+        for i in range(0, len(missing), self._MAX_QUERY_PARAMS):
+            chunk = missing[i:i + self._MAX_QUERY_PARAMS]
+            query = ('SELECT handle, first_name, last_name, country, city, organization, contribution, '
+                     '    rating, maxRating, last_online_time, registration_time, friend_of_count, title_photo '
+                     'FROM cf_user_cache '
+                     'WHERE LOWER(handle) IN ({})'.format(', '.join(['?'] * len(chunk))))
+            for row in self._fetch_tuples(query, chunk):
+                user = cf.User._make(row)
+                self._cf_user_by_handle[user.handle.lower()] = user
+        return [self._cf_user_by_handle.get(lower) for lower in lowers]
 
     def set_handle(self, user_id, guild_id, handle):
         query = ('SELECT user_id '
@@ -496,6 +739,8 @@ class UserDbConn:
         res = None
         with self.conn:
             res = self.conn.execute(query, (user_id, guild_id, handle)).rowcount
+        self._get_guild_handles(guild_id).set(str(user_id), handle, 1)
+        self._track_guild_handles(guild_id)
         self.update()
         return res
 
@@ -521,17 +766,26 @@ class UserDbConn:
                  'SET active = 0 '
                  'WHERE guild_id = ? AND user_id = ?')
         res = None
+        guild_id_user_id_pairs = list(guild_id_user_id_pairs)
         with self.conn:
             res = self.conn.executemany(query, guild_id_user_id_pairs).rowcount
+        for guild_id, user_id in guild_id_user_id_pairs:
+            guild_handles = self._guild_handles.get(str(guild_id))
+            if guild_handles is not None:
+                guild_handles.set_inactive(str(user_id))
+                self._track_guild_handles(guild_id)
         self.update()
         return res
 
     def get_handle(self, user_id, guild_id):
-        query = ('SELECT handle '
-                 'FROM user_handle '
-                 'WHERE user_id = ? AND guild_id = ?')
-        res = self.conn.execute(query, (user_id, guild_id)).fetchone()
-        return res[0] if res else None
+        entry = self._get_guild_handles(guild_id).handle_by_user_id.get(str(user_id))
+        return entry[0] if entry else None
+
+    def get_handles(self, user_ids, guild_id):
+        """Returns the handle of each of `user_ids`, or None for users without one."""
+        handle_by_user_id = self._get_guild_handles(guild_id).handle_by_user_id
+        entries = (handle_by_user_id.get(str(user_id)) for user_id in user_ids)
+        return [entry[0] if entry else None for entry in entries]
 
     def get_account_id(self, user_id, guild_id, resource):
         query = ('SELECT account_id '
@@ -540,6 +794,21 @@ class UserDbConn:
         res = self.conn.execute(query, (user_id, guild_id, resource)).fetchone()
         return res[0] if res else None
 
+    def get_account_ids(self, user_ids, guild_id, resource):
+        """Returns the account id on `resource` of each of `user_ids`, or None for users without
+        one."""
+        user_ids = [str(user_id) for user_id in user_ids]
+        account_id_by_user_id = {}
+        for i in range(0, len(user_ids), self._MAX_QUERY_PARAMS - 2):
+            chunk = user_ids[i:i + self._MAX_QUERY_PARAMS - 2]
+            query = ('SELECT user_id, account_id '
+                     'FROM clist_account_ids '
+                     'WHERE guild_id = ? AND resource = ? AND user_id IN ({})'
+                     .format(', '.join(['?'] * len(chunk))))
+            res = self._fetch_tuples(query, (str(guild_id), resource, *chunk))
+            account_id_by_user_id.update(res)
+        return [account_id_by_user_id.get(user_id) for user_id in user_ids]
+
     def get_all_handles(self, guild_id):
         query = ('SELECT handle '
                  'FROM clist_account_ids '
@@ -570,11 +839,13 @@ class UserDbConn:
 
 
     def get_user_id(self, handle, guild_id):
-        query = ('SELECT user_id '
-                 'FROM user_handle '
-                 'WHERE UPPER(handle) = UPPER(?) AND guild_id = ? AND active = 1')
-        res = self.conn.execute(query, (handle, guild_id)).fetchone()
-        return int(res[0]) if res else None
+        return self.get_user_ids([handle], guild_id)[0]
+
+    def get_user_ids(self, handles, guild_id):
+        """Returns the id of the active user with each of `handles`, ignoring case, or None."""
+        user_id_by_handle = self._get_guild_handles(guild_id).active_user_id_by_handle
+        user_ids = (user_id_by_handle.get(handle.lower()) for handle in handles)
+        return [int(user_id) if user_id is not None else None for user_id in user_ids]
 
     def remove_handle(self, user_id, guild_id):
         query = ('DELETE FROM user_handle '
@@ -587,15 +858,15 @@ class UserDbConn:
         res2 = None
         with self.conn:
             res2 = self.conn.execute(query, (user_id, guild_id)).rowcount
+        self._get_guild_handles(guild_id).remove(str(user_id))
+        self._track_guild_handles(guild_id)
         self.update()
         return res1 or res2
 
     def get_handles_for_guild(self, guild_id):
-        query = ('SELECT user_id, handle '
-                 'FROM user_handle '
-                 'WHERE guild_id = ? AND active = 1')
-        res = self.conn.execute(query, (guild_id,)).fetchall()
-        return [(int(user_id), handle) for user_id, handle in res]
+        handle_by_user_id = self._get_guild_handles(guild_id).handle_by_user_id
+        return [(int(user_id), handle) for user_id, (handle, active) in handle_by_user_id.items()
+                if active]
     
     def get_account_ids_for_resource(self, guild_id, resource):
         query = ('SELECT user_id, account_id, handle '
@@ -612,9 +883,28 @@ class UserDbConn:
                  'LEFT JOIN cf_user_cache AS c '
                  'ON u.handle = c.handle '
                  'WHERE u.guild_id = ? AND u.active = 1')
-        res = self.conn.execute(query, (guild_id,)).fetchall()
+        res = self._fetch_tuples(query, (guild_id,))
         return [(int(t[0]), cf.User._make(t[1:])) for t in res]
 
+    _CF_USER_COLUMNS = ('handle', 'first_name', 'last_name', 'country', 'city', 'organization',
+                        'contribution', 'rating', 'maxRating', 'last_online_time',
+                        'registration_time', 'friend_of_count', 'title_photo')
+
+    def get_cf_user_columns_for_guild(self, guild_id, *columns):
+        """Like `get_cf_users_for_guild`, but returns a list of user ids followed by a list for
+        each of the given cf_user_cache columns, without building an object per user."""
+        for column in columns:
+            if column not in self._CF_USER_COLUMNS:
+                raise ValueError(f'Unknown column {column}')
+        select = ', '.join(['u.user_id'] + [f'c.{column}' for column in columns])
+        query = (f'SELECT {select} '
+                 'FROM user_handle AS u '
+                 'LEFT JOIN cf_user_cache AS c '
+                 'ON u.handle = c.handle '
+                 'WHERE u.guild_id = ? AND u.active = 1')
+        user_ids, *values = self._fetch_columns(query, (guild_id,))
+        return ([int(user_id) for user_id in user_ids], *values)
+
     def get_reminder_settings(self, guild_id):
         query = '''
             SELECT channel_id, role_id, before, timezone, website_allowed_patterns, website_disallowed_patterns
@@ -755,6 +1045,7 @@ class UserDbConn:
         self.update()
         return duelid
 
+    @_atomic
     def cancel_duel(self, duelid, status):
         query = f'''
             UPDATE duel SET status = ? WHERE id = ? AND status = {Duel.PENDING}
@@ -767,6 +1058,7 @@ class UserDbConn:
         self.update()
         return rc
 
+    @_atomic
     def invalidate_duel(self, duelid):
         query = f'''
             UPDATE duel SET status = {Duel.INVALID} WHERE id = ? AND status = {Duel.ONGOING}
@@ -779,6 +1071,7 @@ class UserDbConn:
         self.update()
         return rc
 
+    @_atomic
     def start_duel(self, duelid, start_time):
         query = f'''
             UPDATE duel SET start_time = ?, status = {Duel.ONGOING}
@@ -792,6 +1085,7 @@ class UserDbConn:
         self.update()
         return rc
 
+    @_atomic
     def complete_duel(self, duelid, winner, finish_time, winner_id = -1, loser_id = -1, delta = 0, dtype = DuelType.OFFICIAL):
         query = f'''
             UPDATE duel SET status = {Duel.COMPLETE}, finish_time = ?, winner = ? WHERE id = ? AND status = {Duel.ONGOING}
@@ -1030,6 +1324,7 @@ class UserDbConn:
         '''
         self.conn.execute(inactive_query, (id,))
         self.conn.commit()
+        self._invalidate_guild_handles(id)
 
     def update_status(self, guild_id: str, active_ids: list):
         placeholders = ', '.join(['?'] * len(active_ids))
@@ -1042,6 +1337,7 @@ class UserDbConn:
         '''.format(placeholders)
         rc = self.conn.execute(active_query, (*active_ids, guild_id)).rowcount
         self.conn.commit()
+        self._invalidate_guild_handles(guild_id)
         return rc
 
     # Rated VC stuff
@@ -1280,5 +1576,9 @@ class UserDbConn:
         return res
 
     def close(self):
-        self.update()
-        self.conn.close()
+        self.group_commit.flush()
+        # Refreshes the statistics of the tables that grew since they were gathered.
+        self.conn.execute('PRAGMA optimize')
+        if self.backup is not None:
+            self.backup.flush_sync()
+        super().close()
@@ -2,18 +2,30 @@
     A case insensitive dictionay with bare minimum functions required for handling usernames.
 """
 
+import sys
+
+
 class HandleDict:
-    def __init__(self):
+    __slots__ = ('_store', '_intern')
+
+    def __init__(self, *, intern=False):
+        """With `intern`, handles are interned, so that dicts holding the same handles, like
+        the ranklists of different contests, share the strings instead of each keeping copies.
+        """
         self._store = {}
+        self._intern = intern
 
     @staticmethod
     def _getlower(key):
-        return key.lower() if type(key)==str else key
+        return key.lower() if type(key) is str else key
 
     def __setitem__(self, key, value):
         # Use the lowercased key for lookups, but store the actual
         # key alongside the value.
-        self._store[self._getlower(key)] = (key, value)
+        lower = self._getlower(key)
+        if self._intern and type(key) is str:
+            key, lower = sys.intern(key), sys.intern(lower)
+        self._store[lower] = (key, value)
 
     def __getitem__(self, key):
         return self._store[self._getlower(key)][1]
@@ -21,11 +33,29 @@ class HandleDict:
     def __delitem__(self, key):
         del self._store[self._getlower(key)]
 
+    def __contains__(self, key):
+        return self._getlower(key) in self._store
+
+    def __len__(self):
+        return len(self._store)
+
     def __iter__(self):
         return (cased_key for cased_key, mapped_value in self._store.values())
 
+    def get(self, key, default=None):
+        item = self._store.get(self._getlower(key))
+        return default if item is None else item[1]
+
+    def get_many(self, keys, default=None):
+        """Return the values for all of `keys` as a list, with `default` for missing ones."""
+        store_get = self._store.get
+        getlower = self._getlower
+        missing = (None, default)
+        return [store_get(getlower(key), missing)[1] for key in keys]
+
     def items(self):
-        return dict([value for value in self._store.values()]).items()
+        # The stored (key, value) pairs are exactly the items, so no copy is needed.
+        return self._store.values()
 
     def __repr__(self):
-        return str(self.items())
+        return str(dict(self.items()))
@@ -0,0 +1,101 @@
+"""
+    Rating prediction off the event loop.
+
+    Predicting the rating changes of a big round takes long enough to stall the bot if it is done
+    on the event loop, so predictions are run in a pool of worker processes instead. The standings
+    are sent to the workers in a compact form, one array per column, which is much cheaper to
+    pickle than a list of tuples.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from tle.util.ranklist.rating_calculator import CodeforcesRatingCalculator
+
+logger = logging.getLogger(__name__)
+
+_MAX_WORKERS = 4
+
+PredictionInput = namedtuple('PredictionInput', 'ids points penalty rating')
+
+
+def make_input(standings):
+    """Convert a list of (id, points, penalty, rating) tuples to a `PredictionInput`."""
+    if standings:
+        ids, points, penalty, rating = zip(*standings)
+    else:
+        ids, points, penalty, rating = (), (), (), ()
+    return PredictionInput(list(ids), np.array(points, dtype=float),
+                           np.array(penalty, dtype=np.int64), np.array(rating, dtype=np.int64))
+
+
+def calculate_rating_changes(field, seed_key=None):
+    """Return a mapping between the ids of the `PredictionInput` `field` and their delta."""
+    calculator = CodeforcesRatingCalculator.from_arrays(*field, seed_key=seed_key)
+    return calculator.calculate_rating_changes()
+
+
+def calculate_virtual_rating_changes(field, virtual, seed_key=None):
+    """Return a mapping between the ids of the `PredictionInput` `virtual` and their delta as if
+    each one of them alone had joined `field`."""
+    calculator = CodeforcesRatingCalculator.from_arrays(*field, seed_key=seed_key)
+    return calculator.calculate_virtual_rating_changes(list(zip(*virtual)))
+
+
+def _mp_context():
+    # Workers forked from the bot process would inherit its event loop, sockets and threads, so
+    # fork them from a clean server process where that is available.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['tle.util.ranklist.rating_calculator'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+class PredictionService:
+    """Runs rating predictions in a process pool. Predictions for different contests run in
+    parallel, up to the number of workers."""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or min(_MAX_WORKERS, os.cpu_count() or 1)
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=_mp_context())
+        return self._executor
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        except BrokenProcessPool:
+            # A worker died, most likely killed by the OS. Start a fresh pool and try once more.
+            logger.warning('Prediction process pool is broken, restarting it.')
+            self.shutdown()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+
+    async def predict(self, field, seed_key=None):
+        """Same as `calculate_rating_changes`, without blocking the event loop."""
+        if not field.ids:
+            return {}
+        return await self._run(calculate_rating_changes, field, seed_key)
+
+    async def predict_virtual(self, field, virtual, seed_key=None):
+        """Same as `calculate_virtual_rating_changes`, without blocking the event loop."""
+        if not field.ids or not virtual.ids:
+            return {}
+        return await self._run(calculate_virtual_rating_changes, field, virtual, seed_key)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
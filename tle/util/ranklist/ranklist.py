@@ -1,6 +1,6 @@
 from discord.ext import commands
 
-from tle.util.ranklist.rating_calculator import CodeforcesRatingCalculator
+from tle.util.ranklist import prediction
 from tle.util.handledict import HandleDict
 
 
@@ -36,17 +36,37 @@ class Ranklist:
 
         self.is_rated = is_rated
 
-        self.standing_by_id = HandleDict()
-        for row in self.standings:
+        self.standing_by_id = self._index_standings(standings)
+
+        self.delta_by_handle = None
+        self.deltas_status = None
+        # The (id, points, penalty, rating) rows that the current prediction was made from.
+        self.prediction_input = None
+
+    @staticmethod
+    def _index_standings(standings):
+        # Handles recur across the ranklists of different contests, intern them to share memory.
+        standing_by_id = HandleDict(intern=True)
+        for row in standings:
             if row.party.ghost:
                 # Apparently ghosts don't have team ID.
                 id_ = row.party.teamName
             else:
                 id_ = row.party.teamId or row.party.members[0].handle
-            self.standing_by_id[id_] = row
+            standing_by_id[id_] = row
+        return standing_by_id
 
-        self.delta_by_handle = None
-        self.deltas_status = None
+    def __getstate__(self):
+        # Keep pickles small. The index is rebuilt from the standings, and the prediction input
+        # only saves a recalculation.
+        state = self.__dict__.copy()
+        del state['standing_by_id']
+        state['prediction_input'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.standing_by_id = self._index_standings(self.standings)
 
     def set_deltas(self, delta_by_handle):
         if not self.is_rated:
@@ -54,13 +74,54 @@ class Ranklist:
         self.delta_by_handle = delta_by_handle.copy()
         self.deltas_status = 'Final'
 
-    def predict(self, current_rating):
+    async def predict(self, current_rating, *, previous=None, service=None):
+        """Predict rating changes from the given ratings. If `previous` is a ranklist whose
+        prediction was made from exactly the same points, penalties and ratings, its deltas are
+        reused instead of being recalculated. If a `PredictionService` is given, the calculation
+        runs there instead of on the event loop.
+        """
         if not self.is_rated:
             raise ContestNotRatedError(self.contest)
         standings = [(id_, row.points, row.penalty, current_rating[id_])
                      for id_, row in self.standing_by_id.items() if id_ in current_rating]
-        if standings:
-            self.delta_by_handle = CodeforcesRatingCalculator(standings).calculate_rating_changes()
+        if (previous is not None and previous.deltas_status == 'Predicted' and
+                previous.prediction_input == standings):
+            self.delta_by_handle = previous.delta_by_handle
+        elif standings:
+            field = prediction.make_input(standings)
+            # Predictions for the same contest mostly share the field, so let them share seeds.
+            seed_key = self.contest.id
+            if service is not None:
+                self.delta_by_handle = await service.predict(field, seed_key)
+            else:
+                self.delta_by_handle = prediction.calculate_rating_changes(field, seed_key)
+        self.prediction_input = standings
+        self.deltas_status = 'Predicted'
+
+    async def predict_virtual(self, current_rating, virtual_rating, *, service=None):
+        """Predict rating changes for the ids in `virtual_rating` as if each one of them had been
+        the only one to join the field of ids in `current_rating`. The field is calculated once
+        for all of them. If a `PredictionService` is given, the calculation runs there instead of
+        on the event loop.
+        """
+        if not self.is_rated:
+            raise ContestNotRatedError(self.contest)
+        standings, virtual_standings = [], []
+        for id_, row in self.standing_by_id.items():
+            if id_ in virtual_rating:
+                virtual_standings.append((id_, row.points, row.penalty, virtual_rating[id_]))
+            elif id_ in current_rating:
+                standings.append((id_, row.points, row.penalty, current_rating[id_]))
+        self.delta_by_handle = {}
+        if standings and virtual_standings:
+            field = prediction.make_input(standings)
+            virtual = prediction.make_input(virtual_standings)
+            seed_key = self.contest.id
+            if service is not None:
+                self.delta_by_handle = await service.predict_virtual(field, virtual, seed_key)
+            else:
+                self.delta_by_handle = prediction.calculate_virtual_rating_changes(field, virtual,
+                                                                                   seed_key)
         self.deltas_status = 'Predicted'
 
     def get_delta(self, handle):
@@ -75,3 +136,7 @@ class Ranklist:
             return self.standing_by_id[handle]
         except KeyError:
             raise HandleNotPresentError(self.contest, handle)
+
+    def get_standing_rows(self, handles):
+        """Return the standing rows of `handles`, with None for handles not present."""
+        return self.standing_by_id.get_many(handles)
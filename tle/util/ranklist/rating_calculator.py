@@ -2,108 +2,227 @@
 Adapted from Codeforces code to recalculate ratings
 by Mike Mirzayanov (mirzayanovmr@gmail.com) at https://codeforces.com/contest/1/submission/13861109
 Updated to use the current rating formula.
+
+The calculation is vectorized with NumPy over all contestants, but every step mirrors the original
+per-contestant algorithm so that the results are exactly the same.
 """
 
-from dataclasses import dataclass
+import bisect
+from collections import OrderedDict
 
 import numpy as np
 from numpy.fft import fft, ifft
 
+MAX = 6144
+_MIN_NEED_RATING, _MAX_NEED_RATING = 1, 8000
+
+_elo_win_prob = None
+_elo_win_prob_fft = None
+
+# Seed curves of recent calculations by key, usually the contest, as (rating histogram, seed,
+# number of incremental updates since the last full convolution).
+_seed_cache = OrderedDict()
+_SEED_CACHE_SIZE = 16
+# Changing more ratings than this at once is cheaper with a fresh convolution.
+_MAX_INCREMENTAL_SEED_CHANGES = 64
+# Rounding errors add up over incremental updates, so convolve afresh every so often.
+_MAX_INCREMENTAL_SEED_UPDATES = 30
+# Virtual contestants joining a smaller field are calculated exactly, see
+# `calculate_virtual_rating_changes`.
+_MIN_APPROXIMATE_VIRTUAL_FIELD = 1000
+
 
 def intdiv(x, y):
     return -(-x // y) if x < 0 else x // y
 
 
-@dataclass
-class Contestant:
-    party: str
-    points: float
-    penalty: int
-    rating: int
-    need_rating: int = 0
-    delta: int = 0
-    rank: float = 0.0
-    seed: float = 0.0
+def _intdiv_array(x, y):
+    """`intdiv` for an integer array `x` and a positive integer `y`."""
+    return np.where(x < 0, -(-x // y), x // y)
+
+
+def _get_elo_win_prob():
+    """The ELO win probability for all possible rating differences and its FFT, shared by all
+    calculators."""
+    global _elo_win_prob, _elo_win_prob_fft
+    if _elo_win_prob is None:
+        _elo_win_prob = np.roll(1 / (1 + pow(10, np.arange(-MAX, MAX) / 400)), -MAX)
+        _elo_win_prob_fft = fft(_elo_win_prob)
+    return _elo_win_prob, _elo_win_prob_fft
+
+
+def _get_seed_curve(count, key):
+    """The seed for all possible ratings given the rating histogram `count`. With a `key`, the
+    curve is remembered, and the next curve for the same key is derived from it if the histogram
+    did not change or changed in only a few ratings.
+    """
+    elo_win_prob, elo_win_prob_fft = _get_elo_win_prob()
+    cached = _seed_cache.get(key) if key is not None else None
+    seed = None
+    updates = 0
+    if cached is not None:
+        cached_count, cached_seed, cached_updates = cached
+        changed = np.flatnonzero(count != cached_count)
+        if not len(changed):
+            seed, updates = cached_seed, cached_updates
+        elif (len(changed) <= _MAX_INCREMENTAL_SEED_CHANGES and
+              cached_updates < _MAX_INCREMENTAL_SEED_UPDATES):
+            # The seed is linear in the histogram, every contestant who joined or left adds or
+            # removes a shifted copy of the ELO win probabilities.
+            seed = cached_seed.copy()
+            for rating in changed.tolist():
+                seed += (count[rating] - cached_count[rating]) * np.roll(elo_win_prob, rating)
+            updates = cached_updates + 1
+    if seed is None:
+        seed = 1 + ifft(fft(count) * elo_win_prob_fft).real
+    if key is not None:
+        _seed_cache[key] = count, seed, updates
+        _seed_cache.move_to_end(key)
+        if len(_seed_cache) > _SEED_CACHE_SIZE:
+            _seed_cache.popitem(last=False)
+    return seed
+
+
+def _sqrt(values):
+    # Python's float power and np.sqrt differ in the last bit for some values. The original
+    # implementation used the former, so stick to it.
+    return np.array([value ** 0.5 for value in values.tolist()])
 
 
 class CodeforcesRatingCalculator:
-    def __init__(self, standings):
-        """Calculate Codeforces rating changes and seeds given contest and user information."""
-        self.contestants = [Contestant(handle, points, penalty, rating)
-                            for handle, points, penalty, rating in standings]
-        self._precalc_seed()
+    def __init__(self, standings, *, seed_key=None):
+        """Calculate Codeforces rating changes and seeds given contest and user information.
+        Calculations sharing a `seed_key`, such as repeated predictions for one contest, reuse
+        each other's seed curve."""
+        if standings:
+            parties, points, penalty, rating = zip(*standings)
+        else:
+            parties, points, penalty, rating = (), (), (), ()
+        self._calculate(parties, points, penalty, rating, seed_key)
+
+    @classmethod
+    def from_arrays(cls, parties, points, penalty, rating, *, seed_key=None):
+        """Same as the constructor, but with one sequence or array for each column of the
+        standings."""
+        calculator = cls.__new__(cls)
+        calculator._calculate(parties, points, penalty, rating, seed_key)
+        return calculator
+
+    def _calculate(self, parties, points, penalty, rating, seed_key):
+        self.parties = list(parties)
+        self.points = np.array(points, dtype=float)
+        self.penalty = np.array(penalty, dtype=np.int64)
+        self.rating = np.array(rating, dtype=np.int64)
+        self.elo_win_prob, _ = _get_elo_win_prob()
+        self._precalc_seed(seed_key)
         self._reassign_ranks()
         self._process()
         self._update_delta()
 
     def calculate_rating_changes(self):
         """Return a mapping between contestants and their corresponding delta."""
-        return {contestant.party: contestant.delta for contestant in self.contestants}
-
-    def get_seed(self, rating, me=None):
-        """Get seed given a rating and user."""
+        return dict(zip([self.parties[i] for i in self._order.tolist()],
+                        self.delta[self._order].tolist()))
+
+    def calculate_virtual_rating_changes(self, standings):
+        """Return a mapping between the given contestants, who are not part of the field, and
+        their delta as if each one of them alone had joined the field.
+
+        For a field of fewer than `_MIN_APPROXIMATE_VIRTUAL_FIELD` contestants, the field is
+        recalculated with each contestant added. For a bigger field, a contestant's own term
+        cancels out of their seed, so the field's seeds are used as they are, and the field's
+        correction is reused. That costs a single binary search per contestant, but is an
+        approximation: the correction of the field with the contestant differs slightly. The
+        deltas then differ from a full recalculation by at most 1 from 1000 contestants on.
+        """
+        if not standings:
+            return {}
+        if len(self.parties) < _MIN_APPROXIMATE_VIRTUAL_FIELD:
+            return dict(self._calculate_virtual_rating_change(*row) for row in standings)
+        parties, points, penalty, rating = zip(*standings)
+        rank_keys = list(zip((-self.points[self._by_rank]).tolist(),
+                             self.penalty[self._by_rank].tolist()))
+        # Tied contestants all get the rank of the last one in the tie.
+        rank = np.array([bisect.bisect_right(rank_keys, (-p, q)) + 1
+                         for p, q in zip(points, penalty)])
+        rating = np.array(rating, dtype=np.int64)
+        mid_rank = _sqrt(rank * self.seed[rating])
+        need_rating = self._rank_to_rating(mid_rank, None)
+        delta = _intdiv_array(need_rating - rating, 2) + self.correction
+        return dict(zip(parties, delta.tolist()))
+
+    def _calculate_virtual_rating_change(self, party, points, penalty, rating):
+        """The (party, delta) of one contestant joining the field, recalculated in full."""
+        calculator = CodeforcesRatingCalculator.from_arrays(
+            self.parties + [party], np.append(self.points, points),
+            np.append(self.penalty, penalty), np.append(self.rating, rating))
+        return party, int(calculator.delta[-1])
+
+    def get_seed(self, rating, own_rating=None):
+        """Get seed given a rating, excluding the contestant with rating `own_rating` if given.
+        Both arguments may be arrays."""
         seed = self.seed[rating]
-        if me:
-            seed -= self.elo_win_prob[rating - me.rating]
+        if own_rating is not None:
+            seed = seed - self.elo_win_prob[rating - own_rating]
         return seed
 
-    def _precalc_seed(self):
-        MAX = 6144
-
-        # Precompute the ELO win probability for all possible rating differences.
-        self.elo_win_prob = np.roll(1 / (1 + pow(10, np.arange(-MAX, MAX) / 400)), -MAX)
-
+    def _precalc_seed(self, seed_key):
         # Compute the rating histogram.
-        count = np.zeros(2 * MAX)
-        for a in self.contestants:
-            count[a.rating] += 1
+        count = np.bincount(self.rating % (2 * MAX), minlength=2 * MAX).astype(float)
 
-        # Precompute the seed for all possible ratings using FFT.
-        self.seed = 1 + ifft(fft(count) * fft(self.elo_win_prob)).real
+        # Precompute the seed for all possible ratings using FFT, or reuse a recent one.
+        self.seed = _get_seed_curve(count, seed_key)
 
     def _reassign_ranks(self):
         """Find the rank of each contestant."""
-        contestants = self.contestants
-        contestants.sort(key=lambda o: (-o.points, o.penalty))
-        points = penalty = rank = None
-        for i in reversed(range(len(contestants))):
-            if contestants[i].points != points or contestants[i].penalty != penalty:
-                rank = i + 1
-                points = contestants[i].points
-                penalty = contestants[i].penalty
-            contestants[i].rank = rank
+        # Stable, like the sort of the original implementation.
+        self._by_rank = by_rank = np.lexsort((self.penalty, -self.points))
+        points, penalty = self.points[by_rank], self.penalty[by_rank]
+        # Tied contestants all get the rank of the last one in the tie.
+        changed = (points[1:] != points[:-1]) | (penalty[1:] != penalty[:-1])
+        group = np.concatenate(([0], np.cumsum(changed)))
+        group_end = np.flatnonzero(np.concatenate((changed, [True])))
+        self.rank = np.empty(len(by_rank), dtype=np.int64)
+        self.rank[by_rank] = group_end[group] + 1
 
     def _process(self):
         """Process and assign approximate delta for each contestant."""
-        for a in self.contestants:
-            a.seed = self.get_seed(a.rating, a)
-            mid_rank = (a.rank * a.seed) ** 0.5
-            a.need_rating = self._rank_to_rating(mid_rank, a)
-            a.delta = intdiv(a.need_rating - a.rating, 2)
-
-    def _rank_to_rating(self, rank, me):
-        """Binary Search to find the performance rating for a given rank."""
-        left, right = 1, 8000
-        while right - left > 1:
+        self.contestant_seed = self.get_seed(self.rating, self.rating)
+        mid_rank = _sqrt(self.rank * self.contestant_seed)
+        self.need_rating = self._rank_to_rating(mid_rank, self.rating)
+        self.delta = _intdiv_array(self.need_rating - self.rating, 2)
+
+    def _rank_to_rating(self, rank, own_rating):
+        """Binary Search to find the performance rating for given ranks, for all contestants at
+        once."""
+        left = np.full(len(rank), _MIN_NEED_RATING, dtype=np.int64)
+        right = np.full(len(rank), _MAX_NEED_RATING, dtype=np.int64)
+        while True:
+            active = right - left > 1
+            if not active.any():
+                return left
             mid = (left + right) // 2
-            if self.get_seed(mid, me) < rank:
-                right = mid
-            else:
-                left = mid
-        return left
+            below = self.get_seed(mid, own_rating) < rank
+            right = np.where(active & below, mid, right)
+            left = np.where(active & ~below, mid, left)
 
     def _update_delta(self):
         """Update the delta of each contestant."""
-        contestants = self.contestants
-        n = len(contestants)
+        n = len(self.parties)
+        if n == 0:
+            self._order = np.array([], dtype=np.int64)
+            self.correction = 0
+            return
+
+        # Sort by rating, ties in rank order, like the original implementation.
+        by_rank = self._by_rank
+        self._order = order = by_rank[np.argsort(-self.rating[by_rank], kind='stable')]
 
-        contestants.sort(key=lambda o: -o.rating)
-        correction = intdiv(-sum(c.delta for c in contestants), n) - 1
-        for contestant in contestants:
-            contestant.delta += correction
+        correction = intdiv(-int(self.delta.sum()), n) - 1
+        self.delta += correction
 
         zero_sum_count = min(4 * round(n ** 0.5), n)
-        delta_sum = -sum(contestants[i].delta for i in range(zero_sum_count))
-        correction = min(0, max(-10, intdiv(delta_sum, zero_sum_count)))
-        for contestant in contestants:
-            contestant.delta += correction
+        delta_sum = -int(self.delta[order[:zero_sum_count]].sum())
+        correction2 = min(0, max(-10, intdiv(delta_sum, zero_sum_count)))
+        self.delta += correction2
+        self.correction = correction + correction2